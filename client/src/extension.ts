@@ -38,6 +38,8 @@ function getClientOptions(): LanguageClientOptions {
         ],
         outputChannelName: "[pygls] AsymptoteLanguageServer",
         synchronize: {
+            // Notify the server about changes to the asyServer settings
+            configurationSection: "asyServer",
             // Notify the server about file changes to '.clientrc files contain in the workspace
             fileEvents: workspace.createFileSystemWatcher("**/.clientrc"),
         },
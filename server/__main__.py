@@ -18,6 +18,7 @@ import argparse
 import logging
 
 from .server import asy_lsp_server
+from .stats import STATS_DUMP_INTERVAL_IN_SECONDS
 
 logging.basicConfig(filename="pygls.log", level=logging.DEBUG, filemode="w")
 
@@ -29,6 +30,18 @@ def add_arguments(parser):
     parser.add_argument("--ws", action="store_true", help="Use WebSocket server")
     parser.add_argument("--host", default="127.0.0.1", help="Bind to this address")
     parser.add_argument("--port", type=int, default=2087, help="Bind to this port")
+    parser.add_argument(
+        "--trace-file", help="Write a Chrome trace of requests and parses here"
+    )
+    parser.add_argument(
+        "--stats-file", help="Write request statistics as Prometheus text here"
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=STATS_DUMP_INTERVAL_IN_SECONDS,
+        help="Seconds between two writes of the statistics",
+    )
 
 
 def main():
@@ -36,6 +49,10 @@ def main():
     add_arguments(parser)
     args = parser.parse_args()
 
+    if args.trace_file:
+        asy_lsp_server.start_tracing(args.trace_file)
+    if args.stats_file:
+        asy_lsp_server.dump_stats_periodically(args.stats_file, args.stats_interval)
     if args.tcp:
         asy_lsp_server.start_tcp(args.host, args.port)
     elif args.ws:
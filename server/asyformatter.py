@@ -0,0 +1,249 @@
+import re
+
+from .parser import asylexer
+from .parser.ply.lex import lex
+
+INDENT = "  "
+MAX_BLANK_LINES = 1
+
+# binary operators, path operators included, get one space on each side
+_binary = {
+    "DASHES",
+    "LONGDASH",
+    "DOTS",
+    "COLONS",
+    "CARETS",
+    "CONTROLS",
+    "TENSION",
+    "ATLEAST",
+    "AND",
+    "ASSIGN",
+    "SELFOP",
+    "EQ",
+    "NEQ",
+    "LT",
+    "LE",
+    "GT",
+    "GE",
+    "CAND",
+    "COR",
+    "BAR",
+    "AMPERSAND",
+    "+",
+    "-",
+    "*",
+    "/",
+    "#",
+    "%",
+    "?",
+}
+# prefix operators when no operand ends before them, as in "-x" and "--i"
+_unary = {"+", "-", "DASHES", "INCR"}
+_operand_end = {"ID", "LIT", "STRING", "THIS", ")", "]"}
+_no_space_before = {",", ";", ")", "]", "."}
+_no_space_after = {"(", "[", ".", "UNARY"}
+
+# comments and illegal characters are kept as they are
+_verbatim = re.compile(r"/\*.*?\*/|//[^\n]*|\S", re.S)
+
+_lexer = None
+_probe = None
+
+
+def _get_lexer():
+    global _lexer, _probe
+    if _lexer is None:
+        _lexer = lex(module=asylexer)
+        _probe = _lexer.clone()
+    return _lexer
+
+
+def _items(code):
+    r"""
+    Yields (whitespace before, type, text) for every token of `code`.
+    Comments and illegal characters have type None, and the last item is the
+    trailing whitespace with type None and empty text.
+    """
+    lexer = _get_lexer()
+    lexer.input(code)
+    lexer.lineno = 1
+    end = 0
+    for token in iter(lexer.token, None):
+        for m in _verbatim.finditer(code, end, token.lexpos):
+            yield code[end : m.start()], None, m.group()
+            end = m.end()
+        yield code[end : token.lexpos], token.type, code[token.lexpos : lexer.lexpos]
+        end = lexer.lexpos
+    for m in _verbatim.finditer(code, end):
+        yield code[end : m.start()], None, m.group()
+        end = m.end()
+    yield code[end:], None, ""
+
+
+def _can_join(left, right):
+    # removing the space must not merge the two tokens, as in "- -x"
+    _probe.input(left + right)
+    _probe.token()
+    return _probe.lexpos == len(left)
+
+
+def _space(previous, current, ws, block):
+    if current in _no_space_before or previous in _no_space_after:
+        return ""
+    if previous == "{" and current != "}" or current == "}" and previous != "{":
+        # "{ return x; }" for blocks, "{1, 2}" for array initializers
+        return " " if block else ""
+    if previous in (",", ";") or previous in _binary or current in _binary:
+        return " "
+    if current in ("(", "["):
+        return "" if previous in _operand_end else " "
+    if current == "{":
+        return " "
+    return " " if ws else ""
+
+
+def _line_breaks(ws, line, indent, selected):
+    parts = ws.split("\n")
+    lines = range(line, line + len(parts))
+    if all(selected(l) for l in lines):
+        blank_lines = min(len(parts) - 2, MAX_BLANK_LINES)
+        return "\n" * (blank_lines + 1) + indent
+    # only the trailing whitespace and the indentation of selected lines change
+    trailing = ["" if selected(l) else part for l, part in zip(lines, parts)]
+    trailing[-1] = indent if selected(lines[-1]) else parts[-1]
+    return "\n".join(trailing)
+
+
+def format_text(code, ranges=None):
+    r"""
+    Indents `code` by brace depth and normalizes the spacing between tokens.
+    With `ranges`, (start_line, end_line) 0-based and inclusive, only the
+    whitespace on those lines changes.
+    """
+
+    return _format(_items(code), ranges)
+
+
+def _format(items, ranges):
+    def selected(line):
+        return ranges is None or any(start <= line <= end for start, end in ranges)
+
+    out = []
+    line = 0
+    blocks = [(0, True)]  # (indentation level of the content, is a block)
+    headers = []  # nesting of the "(" after if, while and for
+    bodies = 0  # unbraced bodies of if, else, while, for and do
+    after_header = False
+    statement_level = line_level = 0
+    nesting = 0
+    previous = None  # kind of the previous item, None for comments
+    previous_text = ""
+    last = None  # type of the last token
+    for ws, type, text in items:
+        kind = type
+        if type in _unary and last not in _operand_end:
+            kind = "UNARY"
+        is_end = type is None and not text
+        newlines = ws.count("\n")
+
+        if newlines:
+            if type == "}":
+                line_level = blocks[-1][0] - 1
+            elif not blocks[-1][1]:
+                line_level = blocks[-1][0]  # (elements of an array initializer)
+            elif after_header or last in (None, ";", "{", "}"):
+                # a new statement, or a "{" on its own line after if (...)
+                line_level = blocks[-1][0] + bodies - (type == "{" and after_header)
+                if type is not None:
+                    statement_level = line_level
+            elif type == "{":
+                line_level = statement_level  # (brace on its own line)
+            else:
+                line_level = statement_level + 1  # (continuation line)
+            if is_end and all(selected(l) for l in range(line, line + newlines + 1)):
+                ws = "\n"
+            else:
+                ws = _line_breaks(ws, line, INDENT * max(line_level, 0), selected)
+        elif not selected(line):
+            pass
+        elif not out or is_end:
+            ws = ""
+        elif previous is not None and kind is not None:
+            space = _space(previous, kind, ws, blocks[-1][1])
+            if space or not ws or _can_join(previous_text, text):
+                ws = space
+        out.append(ws)
+        out.append(text)
+        line += newlines + text.count("\n")
+        previous, previous_text = kind, text
+        if type is None:
+            continue
+
+        if not newlines and (after_header or last in (None, ";", "{", "}")):
+            statement_level = line_level
+        after_header = False
+        if type == "{":
+            is_block = last not in ("ASSIGN", ",", "{", "(", "[", "]")
+            blocks.append((line_level + 1, is_block))
+            bodies = 0
+        elif type == "}":
+            if len(blocks) > 1:
+                blocks.pop()
+            bodies = 0
+        elif type in ("(", "["):
+            if last in ("IF", "WHILE", "FOR") and type == "(":
+                headers.append(nesting)
+            nesting += 1
+        elif type in (")", "]"):
+            nesting = max(nesting - 1, 0)
+            if headers and headers[-1] == nesting:
+                headers.pop()
+                bodies += 1
+                after_header = True
+        elif type in ("ELSE", "DO"):
+            bodies += 1
+            after_header = True
+        elif type == ";" and not nesting:
+            bodies = 0
+        if type == "IF" and last == "ELSE":
+            bodies -= 1  # (else if)
+        last = type
+    return "".join(out)
+
+
+def format_closed_statement(code):
+    r"""
+    Formats the statement or block closed by the last token of `code`, a ";"
+    or a "}". Returns (first line of the statement, formatted code), or None
+    if the last token closes nothing.
+    """
+    items = list(_items(code))
+    start = _closed_statement(items)
+    if start is None:
+        return None
+    return start, _format(items, [(start, code.count("\n"))])
+
+
+def _closed_statement(items):
+    # first line, 0-based, of the statement or block closed by the last token
+    line = 0
+    start = None  # first line of the current statement
+    blocks = []  # first line of the statements owning the open blocks
+    closed = None
+    for ws, type, text in items:
+        line += ws.count("\n")
+        if type is not None:
+            closed = None
+            if start is None:
+                start = line
+            if type == "{":
+                blocks.append(start)
+                start = None
+            elif type == "}":
+                closed = blocks.pop() if blocks else line
+                start = None
+            elif type == ";":
+                closed = start
+                start = None
+        line += text.count("\n")
+    return closed
@@ -0,0 +1,218 @@
+import hashlib
+import hmac
+import os
+import pickle
+import stat
+import sys
+import types
+from collections import OrderedDict
+
+DOCUMENT_CACHE_BUDGET_IN_BYTES = 256 * 1024 * 1024
+# measured with approximate_size on generated workloads: a parse takes 300 to
+# 700 bytes per token, each result cached on it up to 250 more
+PARSED_BYTES_PER_TOKEN = 700
+CACHED_BYTES_PER_TOKEN = 250
+
+_not_sized = (
+    type,
+    types.ModuleType,
+    types.FunctionType,
+    types.BuiltinFunctionType,
+    types.MethodType,
+)
+
+
+def approximate_size(obj, seen=None):
+    r"""
+    Returns the approximate number of bytes reachable from `obj`, counting
+    every container, instance and value once. Objects whose id is in `seen`
+    are skipped, and the ids of the objects counted are added to it.
+    """
+    if seen is None:
+        seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, _not_sized):
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif hasattr(o, "__dict__"):
+            stack.append(o.__dict__)
+    return total
+
+
+def source_hash(source):
+    return hashlib.blake2b(source.encode(), digest_size=16).hexdigest()
+
+
+def estimated_size(file):
+    r"""
+    Cheap estimate of the bytes of the parse `file` and of the results cached
+    on it, from its number of tokens.
+    """
+    tokens = len(getattr(file, "all_tokens", ()))
+    cached = len(getattr(file, "cache", ()))
+    return tokens * (PARSED_BYTES_PER_TOKEN + cached * CACHED_BYTES_PER_TOKEN)
+
+
+def is_private_directory(path):
+    r"""
+    Whether `path` is a directory owned by the current user that nobody else
+    can read or write.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(st.st_mode):
+        return False
+    if hasattr(os, "getuid") and (
+        st.st_uid != os.getuid() or st.st_mode & (stat.S_IRWXG | stat.S_IRWXO)
+    ):
+        return False
+    return True
+
+
+class DocumentCache(object):
+    r"""
+    The parsed documents, (uri: (FileParsed, parse time)) like a dict, kept
+    under a memory budget. Documents not open in the editor are evicted
+    first, then the least recently used ones. With a spill directory, evicted
+    parses are pickled there and restored when the same source comes back.
+    The spill directory must be private (see tempfile.mkdtemp), and spilled
+    files are signed with a key only this cache knows: files it did not
+    write are never unpickled.
+    """
+
+    def __init__(self, budget=DOCUMENT_CACHE_BUDGET_IN_BYTES, spill_dir=None):
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.spill_key = os.urandom(32)
+        self.entries = OrderedDict()  # least recently used first
+        self.sizes = {}  # (uri: approximate bytes)
+        self.opened = set()  # (uris open in the editor)
+        self.total_size = 0
+        self.evictions = 0
+
+    def __contains__(self, uri):
+        return uri in self.entries
+
+    def __getitem__(self, uri):
+        entry = self.entries[uri]
+        self.entries.move_to_end(uri)
+        return entry
+
+    def __setitem__(self, uri, entry):
+        if uri in self.entries:
+            self._remove(uri)
+        self.entries[uri] = entry
+        self.sizes[uri] = estimated_size(entry[0])
+        self.total_size += self.sizes[uri]
+        self.evict(keep=uri)
+
+    def __delitem__(self, uri):
+        self._remove(uri)
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return list(self.entries)
+
+    def get(self, uri, default=None):
+        return self[uri] if uri in self.entries else default
+
+    def _remove(self, uri):
+        del self.entries[uri]
+        self.total_size -= self.sizes.pop(uri)
+
+    def open(self, uri):
+        self.opened.add(uri)
+
+    def close(self, uri):
+        r"""
+        Drops the parse of a document closed in the editor, spilling it if
+        enabled.
+        """
+        self.opened.discard(uri)
+        if uri in self.entries:
+            self._spill(uri, self.entries[uri])
+            self._remove(uri)
+
+    def measure(self):
+        r"""
+        Estimates the sizes again, the parses having cached more results
+        since they were added.
+        """
+        for uri, (file, _) in self.entries.items():
+            size = estimated_size(file)
+            self.total_size += size - self.sizes[uri]
+            self.sizes[uri] = size
+
+    def evict(self, keep=None):
+        self.measure()
+        while self.total_size > self.budget:
+            candidates = [uri for uri in self.entries if uri != keep]
+            if not candidates:
+                break
+            closed = [uri for uri in candidates if uri not in self.opened]
+            uri = (closed or candidates)[0]
+            self._spill(uri, self.entries[uri])
+            self._remove(uri)
+            self.evictions += 1
+
+    def _spill_path(self, uri, digest):
+        key = hashlib.blake2b(f"{uri}\n{digest}".encode(), digest_size=16)
+        return os.path.join(self.spill_dir, key.hexdigest() + ".pickle")
+
+    def _signature(self, data):
+        return hashlib.blake2b(data, key=self.spill_key, digest_size=32).digest()
+
+    def _spill(self, uri, entry):
+        digest = getattr(entry[0], "source_hash", None)
+        if self.spill_dir is None or digest is None:
+            return
+        path = self._spill_path(uri, digest)
+        if not is_private_directory(self.spill_dir):
+            return
+        try:
+            data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+            with open(path + ".tmp", "wb") as f:
+                f.write(self._signature(data))
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        except (OSError, pickle.PicklingError, RecursionError, TypeError):
+            # a parse that cannot be spilled is parsed again when needed
+            pass
+
+    def restore(self, uri, source):
+        r"""
+        Returns the spilled (FileParsed, parse time) of `uri` for this exact
+        `source`, or None.
+        """
+        if self.spill_dir is None or not is_private_directory(self.spill_dir):
+            return None
+        path = self._spill_path(uri, source_hash(source))
+        try:
+            with open(path, "rb") as f:
+                signature = f.read(32)
+                data = f.read()
+            os.remove(path)
+        except OSError:
+            return None
+        if not hmac.compare_digest(signature, self._signature(data)):
+            return None
+        try:
+            return pickle.loads(data)
+        except (pickle.UnpicklingError, EOFError, AttributeError):
+            return None
@@ -1,51 +1,338 @@
+import argparse
+import asyncio
+import bisect
+import difflib
+import hashlib
+import json
+import os
+import shutil
 import subprocess
 import re
+import sys
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
+from . import asyformatter
+from .parser.utils import traverse_dir_files
 
-def format_code_range(file_path, start_line, start_column, end_line, end_column):
-    # read contents from file
-    lineno = 1
-    contents = []
-    with open(file_path, "r") as f:
-        while lineno < start_line:
-            lineno += 1
-            f.readline()
-        while lineno <= end_line:
-            lineno += 1
-            contents.append(f.readline())
-    contents[0] = contents[0][start_column - 1 :]
-    contents[-1] = contents[-1][:end_column]
-
-    code = "".join(contents)
-
-    cmd_list = ["clang-format", "--style=LLVM"]
-    p = subprocess.Popen(
-        cmd_list,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    stdout, stderr = p.communicate(code.encode())
+CLANG_FORMAT = "clang-format"
+NATIVE = "native"  # asyformatter, driven by the asylexer tokens
+FORMATTERS = (CLANG_FORMAT, NATIVE)
+
+CLANG_FORMAT_STYLE = "LLVM"
+CLANG_FORMAT_CMD = ["clang-format", f"--style={CLANG_FORMAT_STYLE}"]
+CLANG_FORMAT_TIMEOUT_IN_SECONDS = 10
+MAX_CLANG_FORMAT_PROCESSES = 2
+FORMAT_CACHE_SIZE = 64
+FORMAT_CACHE_FILE = ".asy-format-cache.json"
+STATEMENT_START_CANDIDATES = 8
+
+_clang_format_slots = None  # asyncio.Semaphore, created in the server loop
+_format_cache = OrderedDict()  # (content hash, style, ranges): edits
+_formatted_hashes = OrderedDict()  # (content hash, style): None, known outputs
+
+
+def run_clang_format(cmd_list, code=None):
+    r"""
+    Returns the output of `cmd_list` fed `code`, or None if it cannot run,
+    fails, or exceeds CLANG_FORMAT_TIMEOUT_IN_SECONDS.
+    """
+    try:
+        p = subprocess.Popen(
+            cmd_list,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except OSError:
+        return None
+    try:
+        stdout, stderr = p.communicate(
+            code.encode() if code is not None else None,
+            timeout=CLANG_FORMAT_TIMEOUT_IN_SECONDS,
+        )
+    except subprocess.TimeoutExpired:
+        p.kill()
+        p.communicate()
+        return None
     if p.returncode != 0:
         return None
-    clang_passed_text = stdout.decode()
+    return stdout.decode()
+
+
+async def run_clang_format_async(cmd_list, code=None):
+    r"""
+    Same as run_clang_format without blocking the event loop. At most
+    MAX_CLANG_FORMAT_PROCESSES run at once; a process is killed when it
+    exceeds CLANG_FORMAT_TIMEOUT_IN_SECONDS or when the awaiting request is
+    cancelled.
+    """
+    global _clang_format_slots
+    if _clang_format_slots is None:
+        _clang_format_slots = asyncio.Semaphore(MAX_CLANG_FORMAT_PROCESSES)
+
+    async with _clang_format_slots:
+        try:
+            p = await asyncio.create_subprocess_exec(
+                *cmd_list,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        except OSError:
+            return None
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                p.communicate(code.encode() if code is not None else None),
+                CLANG_FORMAT_TIMEOUT_IN_SECONDS,
+            )
+        except asyncio.TimeoutError:
+            p.kill()
+            await p.wait()  # (reaped while holding the slot)
+            return None
+        except asyncio.CancelledError:
+            p.kill()
+            await asyncio.shield(p.wait())
+            raise
+    if p.returncode != 0:
+        return None
+    return stdout.decode()
+
+
+def _style(engine):
+    return CLANG_FORMAT_STYLE if engine == CLANG_FORMAT else engine
+
+
+def format_text(code, engine=CLANG_FORMAT):
+    if engine == NATIVE:
+        return asyformatter.format_text(code)
+    clang_passed_text = run_clang_format(CLANG_FORMAT_CMD, code)
+    if clang_passed_text is None:
+        return None
+
+    return asy_pass(clang_passed_text)
+
+
+async def format_text_async(code, engine=CLANG_FORMAT):
+    if engine == NATIVE:
+        return asyformatter.format_text(code)
+    clang_passed_text = await run_clang_format_async(CLANG_FORMAT_CMD, code)
+    if clang_passed_text is None:
+        return None
+
     return asy_pass(clang_passed_text)
 
 
 def format_code(file_path):
-    cmd_list = ["clang-format", "--style=LLVM", file_path]
-    p = subprocess.Popen(
-        cmd_list,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+    with open(file_path, "r") as f:
+        return format_text(f.read())
+
+
+def _position(lines, line, offset):
+    # (line, character) of `offset` characters after the start of `line`
+    while (
+        line < len(lines) and offset >= len(lines[line]) and lines[line].endswith("\n")
+    ):
+        offset -= len(lines[line])
+        line += 1
+    return line, offset
+
+
+def diff_edits(original, formatted):
+    r"""
+    Returns the edits turning `original` into `formatted` as a list of
+    (start_line, start_character, end_line, end_character, new_text), 0-based.
+    Lines are matched first, then each changed block is trimmed to the
+    characters that actually differ.
+    """
+    a = original.splitlines(keepends=True)
+    b = formatted.splitlines(keepends=True)
+    edits = []
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        old, new = "".join(a[i1:i2]), "".join(b[j1:j2])
+        prefix = len(os.path.commonprefix([old, new]))
+        suffix = len(os.path.commonprefix([old[prefix:][::-1], new[prefix:][::-1]]))
+        start = _position(a, i1, prefix)
+        end = _position(a, i1, len(old) - suffix)
+        edits.append((*start, *end, new[prefix : len(new) - suffix]))
+    return edits
+
+
+def _content_hash(code):
+    return hashlib.blake2b(code.encode(), digest_size=16).digest()
+
+
+def _remember(cache, key, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > FORMAT_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def _cached_edits(code, ranges, style=CLANG_FORMAT_STYLE):
+    r"""
+    Returns (key, edits): edits is the cached result for `code` formatted over
+    `ranges` (None for the whole text), or None if it has to be computed.
+    Text that some earlier run produced is already formatted and gets [].
+    """
+    content = _content_hash(code)
+    if (content, style) in _formatted_hashes:
+        _formatted_hashes.move_to_end((content, style))
+        return None, []
+    key = (content, style, None if ranges is None else tuple(ranges))
+    edits = _format_cache.get(key)
+    if edits is not None:
+        _format_cache.move_to_end(key)
+        edits = list(edits)
+    return key, edits
+
+
+def _cache_edits(key, edits, formatted=None, style=CLANG_FORMAT_STYLE):
+    _remember(_format_cache, key, tuple(edits))
+    if formatted is not None:
+        _remember(_formatted_hashes, (_content_hash(formatted), style), None)
+    return edits
+
+
+def format_edits(code, engine=CLANG_FORMAT):
+    key, edits = _cached_edits(code, None, _style(engine))
+    if edits is not None:
+        return edits
+    formatted = format_text(code, engine)
+    if formatted is None:
+        return None
+    return _cache_edits(key, diff_edits(code, formatted), formatted, _style(engine))
+
+
+async def format_edits_async(code, engine=CLANG_FORMAT):
+    key, edits = _cached_edits(code, None, _style(engine))
+    if edits is not None:
+        return edits
+    formatted = await format_text_async(code, engine)
+    if formatted is None:
+        return None
+    return _cache_edits(key, diff_edits(code, formatted), formatted, _style(engine))
+
+
+def _lines_args(ranges):
+    # ranges are (start_line, end_line), 0-based and inclusive
+    return [f"--lines={start + 1}:{end + 1}" for start, end in ranges]
+
+
+def _edits_in_ranges(edits, ranges):
+    # clang-format keeps the context of the other lines, but asy_pass does not
+    return [
+        edit
+        for edit in edits
+        if any(edit[0] <= end and edit[2] >= start for start, end in ranges)
+    ]
+
+
+def format_ranges_edits(code, ranges, engine=CLANG_FORMAT):
+    r"""
+    Formats the given line ranges of `code` with a single clang-format run
+    over the whole text, so indentation follows the surrounding code.
+    """
+    key, edits = _cached_edits(code, ranges, _style(engine))
+    if edits is not None:
+        return edits
+    if engine == NATIVE:
+        formatted = asyformatter.format_text(code, ranges)
+    else:
+        formatted = run_clang_format(CLANG_FORMAT_CMD + _lines_args(ranges), code)
+        if formatted is None:
+            return None
+        formatted = asy_pass(formatted)
+    edits = _edits_in_ranges(diff_edits(code, formatted), ranges)
+    return _cache_edits(key, edits, style=_style(engine))
+
+
+async def format_ranges_edits_async(code, ranges, engine=CLANG_FORMAT):
+    if engine == NATIVE:
+        return format_ranges_edits(code, ranges, engine)
+    key, edits = _cached_edits(code, ranges, _style(engine))
+    if edits is not None:
+        return edits
+    clang_passed_text = await run_clang_format_async(
+        CLANG_FORMAT_CMD + _lines_args(ranges), code
     )
-    stdout, stderr = p.communicate()
-    if p.returncode != 0:
+    if clang_passed_text is None:
         return None
-    clang_passed_text = stdout.decode()
+    edits = diff_edits(code, asy_pass(clang_passed_text))
+    return _cache_edits(key, _edits_in_ranges(edits, ranges), style=_style(engine))
 
-    return asy_pass(clang_passed_text)
+
+def statement_starts(tokens):
+    r"""
+    Returns the sorted 0-based lines starting with a token at the top level,
+    from the `all_tokens` of a parse: the lines where on-type formatting can
+    start lexing.
+    """
+    starts = []
+    depth = 0
+    for token in tokens:
+        value = token["value"]
+        line, column = token["position"]
+        if not depth and column == 1 and value != "}":
+            starts.append(line - 1)
+        if value == "{":
+            depth += 1
+        elif value == "}":
+            depth = max(depth - 1, 0)
+    return starts
+
+
+def _is_statement_start(lines, line):
+    # not a continuation line: the previous code ends with ";" or "}"
+    if not lines[line][:1].strip():
+        return False
+    for previous in reversed(lines[:line]):
+        previous = previous.strip()
+        if previous and not previous.startswith("//"):
+            return previous.endswith((";", "}"))
+    return True
+
+
+def _statement_start(lines, starts, line, edited):
+    # the starts of a parse older than the text hold from the top of the
+    # file down to the first line edited since
+    if edited is not None:
+        line = min(line, edited - 1)
+    end = bisect.bisect_right(starts, line)
+    for start in reversed(starts[max(end - STATEMENT_START_CANDIDATES, 0) : end]):
+        if start < len(lines) and _is_statement_start(lines, start):
+            return start
+    return 0
+
+
+def format_on_type_edits(code, line, starts=(), edited=None):
+    r"""
+    Formats, with the native engine, the statement or block closed by the
+    ";" or "}" just typed on `line`. Only the text from the top level
+    statement holding `line` to the end of that line is lexed, that
+    statement found among the `starts` of the last parse (see
+    statement_starts), `edited` being the first line changed since that
+    parse, None if it is current. Only the lines of the closed statement are
+    diffed.
+    """
+    lines = code.splitlines(keepends=True)
+    if line >= len(lines):
+        return []
+    first = _statement_start(lines, starts, line, edited)
+    prefix = "".join(lines[first:line]) + lines[line].rstrip("\r\n")
+    closed = asyformatter.format_closed_statement(prefix)
+    if closed is None:
+        return []
+    start, formatted = closed
+    # the lines before `start` are left as they are
+    head = len("".join(lines[first : first + start]))
+    edits = diff_edits(prefix[head:], formatted[head:])
+    start += first
+    return [(sl + start, sc, el + start, ec, text) for sl, sc, el, ec, text in edits]
 
 
 def asy_pass(clang_passed_text: str):
@@ -58,11 +345,165 @@ def asy_pass(clang_passed_text: str):
     return clang_passed_text
 
 
-def main():
-    import os
+def write_atomic(file_path, text):
+    r"""
+    Replaces the content of `file_path` with `text`, so that readers see
+    either the old or the new file, never a partial one.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".asy-format-")
+    try:
+        with open(fd, "w", newline="") as f:
+            f.write(text)
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 
-    result = format_code(r"C:\mygithub\asy-lsp\server\sample.asy")
+def _format_file(task):
+    r"""
+    Formats one file in a worker process. Returns (file_path, status, digest,
+    diff), status being "cached", "unchanged", "changed" or "error", and
+    digest the content hash of the formatted file.
+    """
+    file_path, engine, cached_digest, write, want_diff = task
+    try:
+        with open(file_path, "r", newline="") as f:
+            code = f.read()
+    except (OSError, UnicodeDecodeError):
+        return file_path, "error", None, ""
+    digest = _content_hash(code).hex()
+    if digest == cached_digest:
+        return file_path, "cached", digest, ""
+
+    formatted = format_text(code, engine)
+    if formatted is None:
+        return file_path, "error", None, ""
+    if formatted == code:
+        return file_path, "unchanged", digest, ""
+
+    diff = ""
+    if want_diff:
+        diff = "".join(
+            difflib.unified_diff(
+                code.splitlines(keepends=True),
+                formatted.splitlines(keepends=True),
+                file_path,
+                file_path,
+            )
+        )
+    if write:
+        write_atomic(file_path, formatted)
+    return file_path, "changed", _content_hash(formatted).hex(), diff
+
+
+def _collect_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(traverse_dir_files(path, [".asy"])[0]))
+        else:
+            files.append(path)
+    return [os.path.abspath(f) for f in files]
+
+
+def _load_cache(cache_path, style):
+    # (absolute file path: content hash of the formatted file)
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("style") != style:
+        return {}
+    return cache.get("files", {})
+
+
+def _save_cache(cache_path, style, files):
+    try:
+        write_atomic(cache_path, json.dumps({"style": style, "files": files}))
+    except OSError:
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m server.formatter",
+        description="Formats Asymptote files in place.",
+    )
+    parser.add_argument("paths", nargs="+", help="files, or directories to walk")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="write nothing, exit with 1 if some file would be reformatted",
+    )
+    parser.add_argument(
+        "--diff", action="store_true", help="write nothing, print unified diffs"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes",
+    )
+    parser.add_argument("--engine", choices=FORMATTERS, default=CLANG_FORMAT)
+    parser.add_argument(
+        "--cache",
+        default=FORMAT_CACHE_FILE,
+        help="file remembering the hashes of formatted files, '' to disable",
+    )
+    args = parser.parse_args(argv)
+
+    style = _style(args.engine)
+    cache = _load_cache(args.cache, style) if args.cache else {}
+    write = not (args.check or args.diff)
+    tasks = [
+        (file_path, args.engine, cache.get(file_path), write, args.diff)
+        for file_path in _collect_files(args.paths)
+    ]
+
+    if args.jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            chunksize = max(1, len(tasks) // (args.jobs * 4))
+            results = list(executor.map(_format_file, tasks, chunksize=chunksize))
+    else:
+        results = [_format_file(task) for task in tasks]
+
+    changed = errors = 0
+    for file_path, status, digest, diff in results:
+        if status == "error":
+            errors += 1
+            cache.pop(file_path, None)
+            print(f"error: cannot format {file_path}", file=sys.stderr)
+            continue
+        if status == "changed":
+            changed += 1
+            if diff:
+                sys.stdout.write(diff)
+            if write:
+                print(f"reformatted {file_path}", file=sys.stderr)
+            elif args.check:
+                print(f"would reformat {file_path}", file=sys.stderr)
+            if not write:
+                cache.pop(file_path, None)
+                continue
+        cache[file_path] = digest
+
+    if args.cache:
+        _save_cache(args.cache, style, cache)
+    print(
+        f"{len(results)} files, {changed} "
+        f"{'reformatted' if write else 'to reformat'}, {errors} errors",
+        file=sys.stderr,
+    )
+    if errors:
+        return 2
+    return 1 if args.check and changed else 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
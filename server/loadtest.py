@@ -0,0 +1,339 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+SERVER_CMD = [sys.executable, "-m", "server"]
+REPLAY_TIMEOUT_IN_SECONDS = 60
+
+
+def _frame(message):
+    body = json.dumps(message).encode()
+    return b"Content-Length: %d\r\n\r\n" % len(body) + body
+
+
+def _content_length(headers):
+    for line in headers.decode("ascii").split("\r\n"):
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-length":
+            return int(value)
+    raise ValueError("message without Content-Length")
+
+
+def read_message(stream):
+    r"""
+    Reads one JSON-RPC message from a binary stream, None at end of stream.
+    """
+    headers = b""
+    while not headers.endswith(b"\r\n\r\n"):
+        line = stream.readline()
+        if not line:
+            return None
+        headers += line
+    return json.loads(stream.read(_content_length(headers)))
+
+
+async def read_message_async(reader):
+    try:
+        headers = await reader.readuntil(b"\r\n\r\n")
+        return json.loads(await reader.readexactly(_content_length(headers)))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+def load_session(path):
+    r"""
+    Loads a recorded or scripted session: one JSON object per line with
+    "time" (seconds from the start), "from" ("client" or "server") and
+    "message". Scripted sessions only need the client messages.
+    """
+    records = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+
+def record(session_path, cmd=SERVER_CMD):
+    r"""
+    Runs the server as `cmd` behind this process, forwarding stdin and stdout
+    and appending every message to `session_path`. Configure the editor to
+    start `python -m server.loadtest record SESSION` instead of the server.
+    """
+    server = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    start = time.monotonic()
+    lock = threading.Lock()
+
+    def pump(source, destination, origin, log):
+        while True:
+            message = read_message(source)
+            if message is None:
+                break
+            with lock:
+                entry = {"time": time.monotonic() - start, "from": origin}
+                entry["message"] = message
+                log.write(json.dumps(entry) + "\n")
+                log.flush()
+            destination.write(_frame(message))
+            destination.flush()
+        if origin == "client":
+            destination.close()
+
+    with open(session_path, "w") as log:
+        to_server = threading.Thread(
+            target=pump,
+            args=(sys.stdin.buffer, server.stdin, "client", log),
+            daemon=True,
+        )
+        to_server.start()
+        pump(server.stdout, sys.stdout.buffer, "server", log)
+    code = server.wait()
+    # the client thread can still be blocked reading from the editor
+    sys.stdout.flush()
+    os._exit(code)
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+class Replayer(object):
+    r"""
+    Fake client replaying the client side of a session, with at most
+    `concurrency` requests in flight, and timing every response.
+    """
+
+    def __init__(self, reader, writer, speed=1.0, concurrency=1):
+        self.reader = reader
+        self.writer = writer
+        self.speed = speed
+        self.window = asyncio.Semaphore(concurrency)
+        self.ids = itertools.count(1)
+        self.id_map = {}  # (recorded request id: replayed request id)
+        self.pending = {}  # (replayed request id: (method, send time))
+        self.latencies = {}  # (method: [seconds])
+        self.errors = {}  # (method: count)
+        self.notifications = {}  # (method: count), from the server
+        self.drained = asyncio.Event()
+
+    async def send(self, message):
+        self.writer.write(_frame(dict(message, jsonrpc="2.0")))
+        await self.writer.drain()
+
+    async def _receive(self):
+        while True:
+            message = await read_message_async(self.reader)
+            if message is None:
+                break
+            if "method" in message and "id" in message:
+                await self.send(_answer(message))
+            elif "method" in message:
+                method = message["method"]
+                self.notifications[method] = self.notifications.get(method, 0) + 1
+            elif message.get("id") in self.pending:
+                method, sent = self.pending.pop(message["id"])
+                self.latencies.setdefault(method, []).append(time.perf_counter() - sent)
+                if "error" in message:
+                    self.errors[method] = self.errors.get(method, 0) + 1
+                self.window.release()
+                if not self.pending:
+                    self.drained.set()
+        self.drained.set()
+
+    async def _request(self, message):
+        await self.window.acquire()
+        request_id = next(self.ids)
+        self.id_map[message["id"]] = request_id
+        self.pending[request_id] = (message["method"], time.perf_counter())
+        self.drained.clear()
+        await self.send(dict(message, id=request_id))
+
+    async def run(self, records, timeout=REPLAY_TIMEOUT_IN_SECONDS):
+        receiver = asyncio.ensure_future(self._receive())
+        messages = [r for r in records if r.get("from", "client") == "client"]
+        # the answers of the recorded client to server requests are not replayed
+        messages = [r for r in messages if "method" in r["message"]]
+        methods = {r["message"]["method"] for r in messages}
+
+        start = time.perf_counter()
+        first = messages[0].get("time", 0) if messages else 0
+        for r in messages:
+            if self.speed > 0:
+                delay = (r.get("time", 0) - first) / self.speed
+                await asyncio.sleep(max(0, start + delay - time.perf_counter()))
+            message = r["message"]
+            if message["method"] == "$/cancelRequest":
+                params = message.get("params") or {}
+                params = dict(params, id=self.id_map.get(params.get("id")))
+                message = dict(message, params=params)
+            if "id" in message:
+                await self._request(message)
+            else:
+                await self.send(message)
+
+        if self.pending:
+            try:
+                await asyncio.wait_for(self.drained.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        elapsed = time.perf_counter() - start
+        timed_out = len(self.pending)
+
+        if "shutdown" not in methods:
+            await self._request({"id": None, "method": "shutdown"})
+            try:
+                await asyncio.wait_for(self.drained.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if "exit" not in methods:
+            await self.send({"jsonrpc": "2.0", "method": "exit"})
+        receiver.cancel()
+        return self.report(elapsed, timed_out)
+
+    def report(self, elapsed, timed_out=0):
+        methods = {}
+        for method, values in sorted(self.latencies.items()):
+            if method == "shutdown":
+                continue
+            methods[method] = {
+                "count": len(values),
+                "errors": self.errors.get(method, 0),
+                "p50": _percentile(values, 50),
+                "p90": _percentile(values, 90),
+                "p99": _percentile(values, 99),
+                "max": max(values),
+            }
+        requests = sum(m["count"] for m in methods.values())
+        return {
+            "elapsed": elapsed,
+            "requests": requests,
+            "throughput": requests / elapsed if elapsed else 0.0,
+            "timed_out": timed_out,
+            "methods": methods,
+            "notifications": dict(self.notifications),
+        }
+
+
+def _answer(request):
+    # what a minimal client answers to the requests of the server
+    result = None
+    if request["method"] == "workspace/configuration":
+        result = [{} for _ in request.get("params", {}).get("items", [])]
+    return {"jsonrpc": "2.0", "id": request["id"], "result": result}
+
+
+async def replay(records, cmd=SERVER_CMD, tcp=None, speed=1.0, concurrency=1):
+    r"""
+    Replays `records` against a server started as `cmd` over stdio, or
+    against the server listening on `tcp` = (host, port).
+    """
+    process = None
+    if tcp is not None:
+        reader, writer = await asyncio.open_connection(*tcp)
+    else:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            limit=2**24,
+        )
+        reader, writer = process.stdout, process.stdin
+    try:
+        return await Replayer(reader, writer, speed, concurrency).run(records)
+    finally:
+        writer.close()
+        if process is not None:
+            try:
+                await asyncio.wait_for(process.wait(), 5)
+            except asyncio.TimeoutError:
+                process.kill()
+
+
+def print_report(report, out=sys.stdout):
+    print(f"{'method':<40} {'count':>6} {'errors':>6} ", end="", file=out)
+    print(
+        " ".join(f"{c:>9}" for c in ("p50 ms", "p90 ms", "p99 ms", "max ms")), file=out
+    )
+    for method, s in report["methods"].items():
+        print(
+            f"{method:<40} {s['count']:>6} {s['errors']:>6} "
+            + " ".join(
+                f"{s[key] * 1000:>9.2f}" for key in ("p50", "p90", "p99", "max")
+            ),
+            file=out,
+        )
+    print(
+        f"{report['requests']} requests in {report['elapsed']:.2f} s, "
+        f"{report['throughput']:.1f} requests/s, "
+        f"{report['timed_out']} without response",
+        file=out,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m server.loadtest",
+        description="Records LSP sessions and replays them against the server.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    recorder = commands.add_parser("record", help="proxy the editor and the server")
+    recorder.add_argument("session", help="JSON lines file to write")
+    recorder.add_argument("--server", help="server command line")
+
+    player = commands.add_parser("replay", help="replay a session, report latency")
+    player.add_argument("session", help="recorded or scripted JSON lines file")
+    player.add_argument("--tcp", metavar="HOST:PORT", help="connect to a server")
+    player.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="speed relative to the recording, 0 for no delays",
+    )
+    player.add_argument(
+        "--concurrency", type=int, default=1, help="requests in flight at most"
+    )
+    player.add_argument("--output", help="write the report as JSON")
+    player.add_argument("--server", help="server command line, for stdio")
+    args = parser.parse_args(argv)
+    cmd = shlex.split(args.server) if args.server else SERVER_CMD
+
+    if args.command == "record":
+        return record(args.session, cmd)
+
+    tcp = None
+    if args.tcp:
+        host, _, port = args.tcp.rpartition(":")
+        tcp = (host or "127.0.0.1", int(port))
+    report = asyncio.run(
+        replay(
+            load_session(args.session),
+            cmd,
+            tcp,
+            args.speed,
+            args.concurrency,
+        )
+    )
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
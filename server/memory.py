@@ -0,0 +1,93 @@
+import tracemalloc
+
+from .cache import approximate_size
+from .parser.ast import FileParsed
+
+# attributes of FileParsed, in the order their memory is attributed: an
+# object reachable from several of them counts for the first one
+STRUCTURES = (
+    "all_tokens",
+    "ast",
+    "scopes",
+    "scope_index",
+    "declarations",
+    "references",
+    "unresolved_references",
+    "jump_table",
+    "declaration_table",
+    "unresolved_table",
+    "semantic_tokens",
+    "errors",
+    "cache",
+    "lexer",
+    "parser",
+)
+HOT_SPOTS = 20
+
+
+def structure_sizes(file):
+    r"""
+    Returns {structure: approximate bytes} for the STRUCTURES of `file`, the
+    rest of its attributes counted as "other".
+    """
+    # the lexer and the parser point back to the file
+    seen = {id(file)}
+    sizes = {}
+    for name in STRUCTURES:
+        sizes[name] = approximate_size(getattr(file, name, None), seen)
+    sizes["other"] = approximate_size(vars(file), seen)
+    return sizes
+
+
+def document_report(file):
+    sizes = structure_sizes(file)
+    return {
+        "version": getattr(file, "version", None),
+        "tokens": len(file.all_tokens),
+        "total": sum(sizes.values()),
+        "structures": sizes,
+    }
+
+
+def parse_allocations(path, source, top=HOT_SPOTS):
+    r"""
+    Parses `source` again under tracemalloc. Returns the bytes allocated and
+    still alive once parsed, the peak, the `top` source lines allocating the
+    most, and the sizes of the structures of the parse, with the lexer and
+    the parser the server releases after parsing.
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        file = FileParsed(path)
+        file.parse(source)
+        file.construct_jump_table()
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+    ignored = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    differences = after.filter_traces(ignored).compare_to(
+        before.filter_traces(ignored), "lineno"
+    )
+    hot_spots = [
+        {
+            "file": d.traceback[0].filename,
+            "line": d.traceback[0].lineno,
+            "size": d.size_diff,
+            "count": d.count_diff,
+        }
+        for d in differences[:top]
+        if d.size_diff > 0
+    ]
+    return {
+        "allocated": sum(d.size_diff for d in differences),
+        "peak": peak,
+        "hot_spots": hot_spots,
+        "structures": structure_sizes(file),
+    }
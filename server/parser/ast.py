@@ -4,13 +4,26 @@ from .utils import traverse_dir_files, printlog
 
 from .ply.yacc import yacc
 
+# token types reported as semantic tokens; resolved uses are reported as
+# "USE_" + the type of their declaration
+SEMANTIC_TYPES = [
+    "MODULE",
+    "TYPE",
+    "PARA_TYPE",
+    "RETURN",
+    "RECORD",
+    "VAR",
+    "FUNCTION",
+    "PARAMETER",
+]
+
 
 class FileParsed(object):
     r"""
     The representation of a file that has been parsed.
     """
 
-    def __init__(self, file: str) -> None:
+    def __init__(self, file: str, instrument: bool = False) -> None:
         self.file_path = file
         self.imported_files = []
         self.scopes = Scopes()
@@ -18,19 +31,108 @@ class FileParsed(object):
         self.lexer.states = self
         self.all_tokens = []
         self.ast = None
-        self.parser = yacc(start="file")
+        # an instrumented parser counts reductions and shifts, see bench
+        self.parser = yacc(start="file", instrument=instrument)
         self.parser.states = self
         self.jump_table = {}
+        self.declaration_table = {}
+        self.unresolved_table = {}
+        self.declarations = {}  # (declaration position: declaration token)
+        # spans below are (line, column_start, column_end)
+        self.references = {}  # (declaration position: [span])
+        self.unresolved_references = {}  # (name: [span])
+        self.semantic_tokens = []  # [(line, column, len, resolved type)]
+        self.errors = []  # [(message, position, len)]
+        self.scope_index = None
+        self.cache = {}  # (name: result derived from this parse)
 
-    def find_definiton(self, line, column):
-        if line not in self.jump_table.keys():
+    @staticmethod
+    def _lookup(table, line, column):
+        if line not in table.keys():
             return None
-        current_line_dict = self.jump_table[line]
+        current_line_dict = table[line]
         for key in current_line_dict.keys():
             if key[0] <= column <= key[1]:
                 return current_line_dict[key]
         return None
 
+    def find_definiton(self, line, column):
+        return self._lookup(self.jump_table, line, column)
+
+    def find_declaration(self, line, column):
+        r"""
+        Returns the position of the declaration under (line, column), whether
+        the cursor is on a reference or on the declaration itself.
+        """
+        pos = self._lookup(self.jump_table, line, column)
+        if pos is None:
+            pos = self._lookup(self.declaration_table, line, column)
+        return pos
+
+    def find_unresolved(self, line, column):
+        r"""
+        Returns the name under (line, column) if it has no declaration in this
+        file, i.e. it may come from an imported module.
+        """
+        return self._lookup(self.unresolved_table, line, column)
+
+    def find_exported(self, name):
+        r"""
+        Returns the global declaration of `name`, visible to importing files.
+        """
+        for item in self.scopes.global_scope.symbols.values():
+            if item["value"] == name and item["type"] in ["VAR", "FUNCTION"]:
+                return item
+        return None
+
+    def find_scope(self, line, column):
+        return self.scope_index.find(line, column)
+
+    def visible_declarations(self, line, column):
+        r"""
+        Returns the declarations visible at (line, column), innermost scope
+        first. A name shadowed by an inner declaration is returned once.
+        """
+        names = set()
+        items = []
+        scope = self.find_scope(line, column)
+        while scope is not None:
+            for pos in sorted(scope.symbols.keys()):
+                item = scope.symbols[pos]
+                if item["type"] not in ["VAR", "FUNCTION", "PARAMETER", "RECORD"]:
+                    continue
+                if item["value"] not in names:
+                    names.add(item["value"])
+                    items.append(item)
+            scope = scope.parent
+        return items
+
+    def outline(self, scope=None):
+        r"""
+        Returns the declarations of `scope` (global scope by default) as a
+        list of (token, children), recursing into function and struct bodies.
+        """
+        if scope is None:
+            scope = self.scopes.global_scope
+        items = []
+        for pos in sorted(scope.symbols.keys()):
+            item = scope.symbols[pos]
+            if item["type"] not in ["VAR", "FUNCTION", "RECORD"]:
+                continue
+            children = self.outline(item["body"]) if "body" in item else []
+            items.append((item, children))
+        return items
+
+    def folding_ranges(self):
+        r"""
+        Returns (start line, end line) of every brace block spanning lines.
+        """
+        return sorted(
+            (scope.start[0], scope.end[0])
+            for scope in self.scopes.all_scopes()
+            if scope is not self.scopes.global_scope and scope.end[0] > scope.start[0]
+        )
+
     def _find_dec(self, token):
         if "scope" in token.keys():
             scope = token["scope"]
@@ -44,25 +146,51 @@ class FileParsed(object):
         else:
             return None
 
+    @staticmethod
+    def _add_to_table(table, span, value):
+        line, column_start, column_end = span
+        if line not in table.keys():
+            table[line] = {}
+        table[line][(column_start, column_end)] = value
+
     def construct_jump_table(self):
+        r"""
+        Resolves every ID token to its declaration. Fills the jump table
+        (use -> declaration) and, in the same pass, the reverse index
+        (declaration -> uses, in file order) and the semantic tokens.
+        """
         for token in self.all_tokens:
-            if token["type"] == "ID":
+            line, column_start = token["position"]
+            span = (line, column_start, column_start + token["len"])
+            if token["type"] in SEMANTIC_TYPES:
+                self.semantic_tokens.append(
+                    (line, column_start, token["len"], token["type"])
+                )
+            if token["type"] in ["VAR", "FUNCTION", "PARAMETER"]:
+                self.declarations[token["position"]] = token
+                self._add_to_table(self.declaration_table, span, token["position"])
+                self.references.setdefault(token["position"], [])
+            elif token["type"] == "ID":
                 # import pdb; pdb.set_trace()
                 dec = self._find_dec(token)
                 if dec is not None:
                     printlog(
                         f"Declaration of ({token['value']}, {token['position']}) is at {dec['position']}"
                     )
-                    line, column_start = token["position"]
-                    column_end = column_start + token["len"]
-                    if line not in self.jump_table.keys():
-                        self.jump_table[line] = {}
-                    current_line = self.jump_table[line]
-                    current_line[(column_start, column_end)] = dec["position"]
+                    self._add_to_table(self.jump_table, span, dec["position"])
+                    self.semantic_tokens.append(
+                        (line, column_start, token["len"], "USE_" + dec["type"])
+                    )
+                    self.declarations.setdefault(dec["position"], dec)
+                    self.references.setdefault(dec["position"], []).append(span)
                 else:
                     printlog(
                         f"Declaration of ({token['value']}, {token['position']}) not found"
                     )
+                    self._add_to_table(self.unresolved_table, span, token["value"])
+                    self.unresolved_references.setdefault(token["value"], []).append(
+                        span
+                    )
         return self.jump_table
 
     def add_file(self, id):
@@ -76,16 +204,33 @@ class FileParsed(object):
     def add_symbol(self, *tokens):
         self.scopes.add_symbol(*tokens)
 
-    def parse(self) -> None:
+    def add_error(self, message, position, length):
+        self.errors.append((message, position, length))
+
+    def parse(self, data=None) -> None:
         r"""
-        Parses the file.
+        Parses the file, or `data` as its contents if given.
         """
-        with open(self.file_path) as f:
-            data = f.read()
+        if data is None:
+            with open(self.file_path) as f:
+                data = f.read()
         self.ast = self.parser.parse(data, self.lexer)
+        if self.ast is None and not self.errors:
+            last_line = data.count("\n") + 1
+            last_column = len(data) - data.rfind("\n")
+            self.add_error("Unexpected end of file", (last_line, last_column), 0)
+        self.scope_index = ScopeIndex(self.scopes)
+
+    def release_parser(self) -> None:
+        r"""
+        Drops the lexer and the parser, only needed while parsing, so that the
+        result can be kept or pickled on its own.
+        """
+        self.lexer = None
+        self.parser = None
 
     def __repr__(self) -> str:
-        return f"AST: {self.ast}\n\nTokens: {self.lexer.states.all_tokens}\n\nScopes: {self.scopes}\n\nImported files: {self.imported_files}"
+        return f"AST: {self.ast}\n\nTokens: {self.all_tokens}\n\nScopes: {self.scopes}\n\nImported files: {self.imported_files}"
 
 
 def run_parser(file_path):
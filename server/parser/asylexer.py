@@ -269,4 +269,10 @@ def t_newline(t):
 
 # Error handler for illegal characters
 def t_error(t):
-    print(f"Illegal character {t.value[0]!r}, line:{t.lexer.lineno}")
+    if hasattr(t.lexer, "states"):
+        line = t.lexer.lineno
+        column = _find_column(t.lexer.lexdata, t)
+        t.lexer.states.add_error(
+            f"Illegal character {t.value[0]!r}", (line, column), 1
+        )
+    t.lexer.skip(1)
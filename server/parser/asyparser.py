@@ -1,5 +1,6 @@
-from msilib.schema import Error
+from bisect import bisect_right
 from .ply.yacc import yacc
+from .asylexer import _find_column
 from .utils import printlog
 
 
@@ -87,10 +88,73 @@ class Scopes(object):
         else:
             self.current_scope = None
 
+    def all_scopes(self):
+        # scopes left open (e.g. after a syntax error) stay in self.scopes
+        return self.unused_scopes + self.scopes
+
     def __repr__(self):
         return f"\nself.scopes:\n{self.scopes}\nself.unused_scoes:\n{self.unused_scopes}\nself.global_scope:{self.global_scope}"
 
 
+class ScopeIndex(object):
+    r"""
+    Flattened view of the nested scopes: the file is cut into segments at every
+    '{' and right after every '}', and each segment is owned by the innermost
+    scope covering it. Lookup is a binary search over the segment starts.
+    """
+
+    def __init__(self, scopes: Scopes) -> None:
+        self.starts = []  # (line, column) where each segment begins
+        self.owners = []  # innermost scope of each segment
+        self._build(scopes)
+
+    @staticmethod
+    def _after_end(scope):
+        # scope never closed: it covers the rest of the file
+        if scope.end[0] < 0:
+            return None
+        return (scope.end[0], scope.end[1] + 1)
+
+    def _mark(self, position, scope):
+        if self.starts and self.starts[-1] == position:
+            self.owners[-1] = scope
+        else:
+            self.starts.append(position)
+            self.owners.append(scope)
+
+    def _close(self, stack):
+        closed = stack.pop()
+        self._mark(self._after_end(closed), stack[-1])
+
+    def _build(self, scopes):
+        global_scope = scopes.global_scope
+        nested = [s for s in scopes.all_scopes() if s is not global_scope]
+        nested.sort(key=lambda s: s.start)
+
+        self._mark((0, 0), global_scope)
+        stack = [global_scope]
+        for scope in nested:
+            while len(stack) > 1:
+                end = self._after_end(stack[-1])
+                if end is None or end > scope.start:
+                    break
+                self._close(stack)
+            stack.append(scope)
+            self._mark(scope.start, scope)
+        while len(stack) > 1 and self._after_end(stack[-1]) is not None:
+            self._close(stack)
+
+    def find(self, line, column):
+        r"""
+        Returns the innermost scope containing (line, column), both 1-based.
+        """
+        i = bisect_right(self.starts, (line, column)) - 1
+        return self.owners[max(i, 0)]
+
+    def __len__(self):
+        return len(self.starts)
+
+
 precedence = [
     ("right", "ASSIGN", "SELFOP"),
     ("right", "?", ":"),
@@ -273,6 +337,10 @@ def p_dec_10(p):
     """dec : IMPORT stridpair ';'"""
     printlog("IMPORT-stridpair", *p[1:])
     p[0] = p[2]
+    if "rule" in p[2]:
+        p.parser.states.add_file(p[2]["list"][0])
+    else:
+        p.parser.states.add_file(p[2])
     # { $$ = new importdec($1, $2); }
 
 
@@ -630,6 +698,7 @@ def p_fundec_1(p):
     """fundec : type ID '(' ')' blockstm"""
     p[1]["type"] = "RETURN"
     p[2]["type"] = "FUNCTION"
+    p[2]["body"] = p[5]
 
     p[0] = p[2]
 
@@ -641,6 +710,7 @@ def p_fundec_2(p):
     printlog("fundec:with args", p[4])
     p[1]["type"] = "TYPE"
     p[2]["type"] = "FUNCTION"
+    p[2]["body"] = p[6]
     p[0] = p[2]
 
     p.parser.states.add_symbol(p[1], p[2])
@@ -657,6 +727,11 @@ def p_fundec_2(p):
 
 def p_typedec_1(p):
     """typedec : STRUCT ID block"""
+    p[2]["type"] = "RECORD"
+    p[2]["body"] = p[3]
+    p[0] = p[2]
+
+    p.parser.states.add_symbol(p[2])
     # { $$ = new recorddec($1, $2.sym, $3); }
 
 
@@ -1295,5 +1370,12 @@ def p_stmexplist_2(p):
 
 # Error rule for syntax errors
 def p_error(p):
-    print(f"Syntax error at line:{p.lexer.lineno}")
-    # raise Error("Stop")
+    # the end of file case is reported by FileParsed.parse
+    if p is None or not hasattr(p.lexer, "states"):
+        return
+    if isinstance(p.value, dict):
+        text, position = p.value["value"], p.value["position"]
+    else:
+        text = p.lexer.lexdata[p.lexpos : p.lexer.lexpos]
+        position = (p.lineno, _find_column(p.lexer.lexdata, p))
+    p.lexer.states.add_error(f"Syntax error near {text!r}", position, len(text))
@@ -0,0 +1,415 @@
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+from .ast import FileParsed
+from .utils import traverse_dir_files
+from . import workload
+
+# "parse" includes lexing: the lexer tags every identifier with the scope the
+# grammar actions have opened so far, so the tokens of the "lex" phase cannot
+# be replayed to the parser. Parsing alone is about "parse" minus "lex".
+PHASES = ("setup", "lex", "parse", "resolve", "lookup")
+CHAIN_PHASES = ("parse", "resolve", "imports")
+REGRESSION_THRESHOLD = 0.10
+REGRESSION_MIN_DELTA_IN_SECONDS = 0.0001  # timer noise on tiny files
+SUPERLINEAR_EXPONENT = 1.3  # time ~ size ** exponent between two sizes
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def _stats(values):
+    return {
+        "min": min(values),
+        "median": _percentile(values, 50),
+        "p90": _percentile(values, 90),
+        "max": max(values),
+    }
+
+
+def _run_once(name, data):
+    # (seconds per phase, number of tokens)
+    times = {}
+    start = time.perf_counter()
+    file = FileParsed(name)
+    times["setup"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    file.lexer.input(data)
+    tokens = sum(1 for _ in iter(file.lexer.token, None))
+    times["lex"] = time.perf_counter() - start
+    # the parser lexes again with the same lexer (see PHASES), which must not
+    # see the tokens and the errors of this pass
+    file.all_tokens.clear()
+    file.errors.clear()
+    file.lexer.lineno = 1
+
+    start = time.perf_counter()
+    file.parse(data)
+    times["parse"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    file.construct_jump_table()
+    times["resolve"] = time.perf_counter() - start
+
+    # what go to definition does, for every identifier
+    start = time.perf_counter()
+    for token in file.all_tokens:
+        if token["type"] == "ID":
+            file.find_declaration(*token["position"])
+    times["lookup"] = time.perf_counter() - start
+    return times, tokens
+
+
+def _resolve_chain(files):
+    # (seconds per chain phase, names found in an imported module)
+    times = dict.fromkeys(CHAIN_PHASES, 0.0)
+    modules = {}
+    for name, data in files.items():
+        start = time.perf_counter()
+        file = FileParsed(name)
+        file.parse(data)
+        parsed = time.perf_counter()
+        file.construct_jump_table()
+        times["parse"] += parsed - start
+        times["resolve"] += time.perf_counter() - parsed
+        modules[name[: -len(".asy")]] = file
+
+    # what go to definition does for the names declared in an import
+    start = time.perf_counter()
+    found = 0
+    for file in modules.values():
+        for name in file.unresolved_references:
+            for module in file.imported_files:
+                other = modules.get(module)
+                if other is not None and other.find_exported(name) is not None:
+                    found += 1
+                    break
+    times["imports"] = time.perf_counter() - start
+    return times, found
+
+
+def bench_chain(n, repeat=5, warmup=1):
+    r"""
+    Times workload.import_chain(n) like bench_source, across modules: every
+    module parsed (setup included, the server builds a parser per file) and
+    resolved, then the names each module takes from its import looked up
+    there.
+    """
+    files = workload.import_chain(n)
+    for _ in range(warmup):
+        _resolve_chain(files)
+    samples = {phase: [] for phase in CHAIN_PHASES}
+    found = 0
+    for _ in range(repeat):
+        times, found = _resolve_chain(files)
+        for phase, seconds in times.items():
+            samples[phase].append(seconds)
+    result = {phase: _stats(values) for phase, values in samples.items()}
+    result["modules"] = len(files)
+    result["found"] = found
+    return result
+
+
+def _peak_memory(name, data):
+    # peak bytes allocated by parse and construct_jump_table
+    file = FileParsed(name)
+    tracemalloc.start()
+    try:
+        file.parse(data)
+        file.construct_jump_table()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def grammar_profile(name, data, top=20):
+    r"""
+    Parses `data` with an instrumented parser. Returns the `top` productions
+    by time spent in their rule, by number of reductions, and the `top`
+    terminals by number of shifts.
+    """
+    file = FileParsed(name, instrument=True)
+    file.parse(data)
+    parser = file.parser
+    return {
+        "by_time": parser.top_reductions(top, "seconds"),
+        "by_count": parser.top_reductions(top, "count"),
+        "shifts": parser.top_shifts(top),
+    }
+
+
+def _print_grammar_profile(name, profile, out=sys.stdout):
+    print(f"{name}: productions by time in their rule", file=out)
+    for production, count, seconds in profile["by_time"]:
+        print(f"{seconds * 1000:>10.3f} ms {count:>8} {production}", file=out)
+    print(f"{name}: productions by reductions", file=out)
+    for production, count, seconds in profile["by_count"]:
+        print(f"{count:>8} {seconds * 1000:>10.3f} ms {production}", file=out)
+    print(f"{name}: shifts by terminal", file=out)
+    for terminal, count in profile["shifts"]:
+        print(f"{count:>8} {terminal}", file=out)
+
+
+def bench_source(name, data, repeat=5, warmup=1):
+    r"""
+    Times every phase of `data` `repeat` times after `warmup` untimed runs.
+    """
+    for _ in range(warmup):
+        _run_once(name, data)
+    samples = {phase: [] for phase in PHASES}
+    tokens = 0
+    for _ in range(repeat):
+        times, tokens = _run_once(name, data)
+        for phase in PHASES:
+            samples[phase].append(times[phase])
+
+    result = {
+        "bytes": len(data.encode()),
+        "lines": data.count("\n") + 1,
+        "tokens": tokens,
+        "peak_memory": _peak_memory(name, data),
+    }
+    for phase in PHASES:
+        result[phase] = _stats(samples[phase])
+    lex_time = result["lex"]["median"]
+    result["tokens_per_second"] = tokens / lex_time if lex_time else 0.0
+    return result
+
+
+def summarize(files):
+    r"""
+    Percentiles over the files of the median time of every phase.
+    """
+    summary = {}
+    for phase in PHASES:
+        medians = [result[phase]["median"] for result in files.values()]
+        summary[phase] = {
+            "total": sum(medians),
+            "p50": _percentile(medians, 50),
+            "p90": _percentile(medians, 90),
+            "p99": _percentile(medians, 99),
+        }
+    tokens = sum(result["tokens"] for result in files.values())
+    lex_time = summary["lex"]["total"]
+    summary["tokens"] = tokens
+    summary["tokens_per_second"] = tokens / lex_time if lex_time else 0.0
+    summary["peak_memory"] = max(
+        (result["peak_memory"] for result in files.values()), default=0
+    )
+    return summary
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    r"""
+    Returns [(name, phase, baseline seconds, seconds)] for the median times
+    more than `threshold` slower than in `baseline`.
+    """
+    min_delta = REGRESSION_MIN_DELTA_IN_SECONDS
+    regressions = []
+    for name, result in results["files"].items():
+        old = baseline.get("files", {}).get(name)
+        if old is None:
+            continue
+        for phase in PHASES:
+            if phase not in old:
+                continue
+            before, after = old[phase]["median"], result[phase]["median"]
+            if after > before * (1 + threshold) and after - before > min_delta:
+                regressions.append((name, phase, before, after))
+    return regressions
+
+
+def scaling(files):
+    r"""
+    Returns [(axis, phase, size, next size, exponent)] between successive
+    sizes of the generated workloads, exponent being k in time ~ size ** k.
+    """
+    by_axis = {}
+    for name in files:
+        axis, _, size = name[: -len(".asy")].rpartition("-")
+        if axis in workload.AXES and size.isdigit():
+            by_axis.setdefault(axis, []).append((int(size), files[name]))
+    rows = []
+    for axis, results in by_axis.items():
+        results.sort(key=lambda item: item[0])
+        for (n1, r1), (n2, r2) in zip(results, results[1:]):
+            for phase in PHASES[1:]:
+                t1, t2 = r1[phase]["median"], r2[phase]["median"]
+                if t1 > 0 and t2 > 0 and n2 > n1:
+                    exponent = math.log(t2 / t1) / math.log(n2 / n1)
+                    rows.append((axis, phase, n1, n2, exponent))
+    return rows
+
+
+def corpus(paths):
+    r"""
+    Yields (name, source) of the .asy files under `paths`, named relative to
+    the directory given.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(traverse_dir_files(path, [".asy"])[0])
+            root = path
+        else:
+            files = [path]
+            root = os.path.dirname(path)
+        for file_path in files:
+            with open(file_path) as f:
+                yield os.path.relpath(file_path, root), f.read()
+
+
+def _print_table(files, summary, out=sys.stdout):
+    columns = ("tokens", "lex ms", "parse ms", "resolve ms", "lookup ms", "tok/s")
+    columns += ("peak KiB",)
+    print(f"{'file':<40} " + " ".join(f"{c:>10}" for c in columns), file=out)
+    for name, result in files.items():
+        print(
+            f"{name[-40:]:<40} {result['tokens']:>10} "
+            f"{result['lex']['median'] * 1000:>10.2f} "
+            f"{result['parse']['median'] * 1000:>10.2f} "
+            f"{result['resolve']['median'] * 1000:>10.2f} "
+            f"{result['lookup']['median'] * 1000:>10.2f} "
+            f"{result['tokens_per_second']:>10.0f} "
+            f"{result['peak_memory'] / 1024:>10.0f}",
+            file=out,
+        )
+    for phase in PHASES:
+        s = summary[phase]
+        print(
+            f"{phase:<8} total {s['total'] * 1000:.1f} ms, "
+            f"p50 {s['p50'] * 1000:.2f} ms, p90 {s['p90'] * 1000:.2f} ms, "
+            f"p99 {s['p99'] * 1000:.2f} ms",
+            file=out,
+        )
+    print(f"{summary['tokens_per_second']:.0f} tokens/s lexed", file=out)
+    print("parse times include lexing", file=out)
+
+
+def run(sources, repeat=5, warmup=1):
+    files = {}
+    for name, data in sources:
+        files[name] = bench_source(name, data, repeat, warmup)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeat": repeat,
+            "warmup": warmup,
+        },
+        "files": files,
+        "summary": summarize(files),
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument("paths", nargs="*", help=".asy files or directories")
+    parser.add_argument(
+        "--generate",
+        action="append",
+        default=[],
+        metavar="AXIS[:N,N,...]",
+        help=f"add synthetic workloads, AXIS one of {', '.join(workload.AXES)}",
+    )
+    parser.add_argument(
+        "--chain",
+        action="append",
+        type=int,
+        default=[],
+        metavar="N",
+        help="also resolve names across a generated chain of N imported modules",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument(
+        "--productions",
+        type=int,
+        metavar="N",
+        help="also report the N costliest grammar productions of every file",
+    )
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help="slowdown of a median flagged as a regression",
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m server.parser.bench",
+        description="Times lexing, parsing and jump table construction.",
+    )
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    sources = list(corpus(args.paths))
+    for spec in args.generate:
+        axis, sizes = workload.parse_spec(spec)
+        sources.extend(workload.workloads([axis], sizes))
+    results = run(sources, args.repeat, args.warmup)
+    results["scaling"] = scaling(results["files"])
+    _print_table(results["files"], results["summary"])
+    if args.chain:
+        results["chains"] = {}
+        for n in args.chain:
+            result = bench_chain(n, args.repeat, args.warmup)
+            results["chains"][f"chain-{n}"] = result
+            print(
+                f"chain-{n}: {result['modules']} modules, "
+                + ", ".join(
+                    f"{phase} {result[phase]['median'] * 1000:.2f} ms"
+                    for phase in CHAIN_PHASES
+                )
+                + f", {result['found']} names found in imports"
+            )
+    if args.productions:
+        results["productions"] = {}
+        for name, data in sources:
+            profile = grammar_profile(name, data, args.productions)
+            results["productions"][name] = profile
+            _print_grammar_profile(name, profile)
+    for axis, phase, n1, n2, exponent in results["scaling"]:
+        if exponent > SUPERLINEAR_EXPONENT:
+            print(
+                f"SUPER-LINEAR {axis} {phase}: size {n1} -> {n2}, "
+                f"time ~ size ** {exponent:.2f}",
+                file=sys.stderr,
+            )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, phase, before, after in regressions:
+            print(
+                f"REGRESSION {name} {phase}: "
+                f"{before * 1000:.2f} ms -> {after * 1000:.2f} ms",
+                file=sys.stderr,
+            )
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -65,6 +65,7 @@ import re
 import types
 import sys
 import inspect
+import time
 
 # -----------------------------------------------------------------------------
 #                     === User configurable parameters ===
@@ -635,6 +636,77 @@ class LRParser:
             raise RuntimeError("yacc: internal parser error!!!\n")
 
 
+# -----------------------------------------------------------------------------
+#                          == InstrumentedLRParser ==
+#
+# An LRParser counting the reductions of every production, with the time
+# spent in its grammar rule, and the tokens shifted by terminal. It is built
+# by yacc(instrument=True); the plain LRParser carries no instrumentation.
+# -----------------------------------------------------------------------------
+
+
+class InstrumentedLRParser(LRParser):
+    def __init__(self, lrtab, errorf):
+        super().__init__(lrtab, errorf)
+        self.reductions = {}  # (production string: [count, seconds])
+        self.shifts = {}  # (terminal: count)
+        for p in self.productions:
+            if p.callable is not None:
+                p.callable = self._timed_rule(p.str, p.callable)
+
+    def _timed_rule(self, name, func):
+        counter = self.reductions.setdefault(name, [0, 0.0])
+        clock = time.perf_counter
+
+        def timed(p):
+            start = clock()
+            try:
+                func(p)
+            finally:
+                counter[0] += 1
+                counter[1] += clock() - start
+
+        return timed
+
+    def reset_counters(self):
+        for counter in self.reductions.values():
+            counter[0] = 0
+            counter[1] = 0.0
+        self.shifts.clear()
+
+    def parse(self, input=None, lexer=None, debug=False, tracking=False):
+        if not lexer:
+            from . import lex
+
+            lexer = lex.lexer
+        token = lexer.token
+        shifts = self.shifts
+
+        def counted_token():
+            tok = token()
+            if tok is not None:
+                shifts[tok.type] = shifts.get(tok.type, 0) + 1
+            return tok
+
+        lexer.token = counted_token
+        try:
+            return super().parse(input, lexer, debug, tracking)
+        finally:
+            lexer.token = token
+
+    def top_reductions(self, n=20, key="seconds"):
+        r"""
+        Returns [(production, count, seconds)] of the `n` productions reduced
+        the most, by "seconds" or by "count".
+        """
+        rows = [(name, c, t) for name, (c, t) in self.reductions.items() if c]
+        rows.sort(key=lambda row: row[2] if key == "seconds" else row[1], reverse=True)
+        return rows[:n]
+
+    def top_shifts(self, n=20):
+        return sorted(self.shifts.items(), key=lambda item: item[1], reverse=True)[:n]
+
+
 # -----------------------------------------------------------------------------
 #                          === Grammar Representation ===
 #
@@ -2436,7 +2508,8 @@ def yacc(
     optimize=False,
     debugfile=debug_file,
     debuglog=None,
-    errorlog=None
+    errorlog=None,
+    instrument=False
 ):
 
     # Reference to the parsing method of the last built parser
@@ -2669,7 +2742,8 @@ def yacc(
 
     # Build the parser
     lr.bind_callables(pinfo.pdict)
-    parser = LRParser(lr, pinfo.error_func)
+    parser_class = InstrumentedLRParser if instrument else LRParser
+    parser = parser_class(lr, pinfo.error_func)
 
     parse = parser.parse
     return parser
@@ -0,0 +1,166 @@
+import argparse
+import os
+
+
+def many_globals(n):
+    r"""
+    `n` global variables in one scope, and a sum using a hundred of them.
+    """
+    lines = [f"real g{i} = {i};" for i in range(n)]
+    used = range(0, n, max(1, n // 100))
+    lines.append("real total = " + " + ".join(f"g{i}" for i in used) + ";")
+    return "\n".join(lines) + "\n"
+
+
+def deep_nesting(n):
+    r"""
+    Blocks nested `n` deep, alternating if, for and bare blocks, each one
+    declaring a variable used in the innermost block.
+    """
+    lines = []
+    for i in range(n):
+        indent = "  " * i
+        if i % 3 == 0:
+            lines.append(f"{indent}if (v{i - 1} > 0) {{" if i else "if (true) {")
+        elif i % 3 == 1:
+            lines.append(f"{indent}for (int i{i} = 0; i{i} < 3; ++i{i}) {{")
+        else:
+            lines.append(f"{indent}{{")
+        lines.append(f"{indent}  real v{i} = {i};")
+    used = range(0, n, max(1, n // 50))
+    lines.append("  " * n + "write(" + " + ".join(f"v{i}" for i in used) + ");")
+    for i in reversed(range(n)):
+        lines.append("  " * i + "}")
+    return "\n".join(lines) + "\n"
+
+
+def long_lines(n):
+    r"""
+    A path of `n` points and a sum of `n` terms, each on a single line.
+    """
+    path = "--".join(f"({i},{i % 7})" for i in range(n))
+    terms = " + ".join(f"{i} * x" for i in range(n))
+    return f"real x = 1;\npath p = {path};\ndraw(p);\nreal s = {terms};\n"
+
+
+def array_initializers(n):
+    r"""
+    Array initializers of `n` reals, pairs and strings, and an n/10 by 10
+    matrix.
+    """
+    reals = ", ".join(str(i) for i in range(n))
+    pairs = ", ".join(f"({i},{i + 1})" for i in range(n))
+    strings = ", ".join(f'"s{i}"' for i in range(n))
+    rows = ", ".join(
+        "{" + ", ".join(str(i * 10 + j) for j in range(10)) + "}"
+        for i in range(max(1, n // 10))
+    )
+    return (
+        f"real[] a = {{{reals}}};\n"
+        f"pair[] b = {{{pairs}}};\n"
+        f"string[] c = {{{strings}}};\n"
+        f"real[][] m = {{{rows}}};\n"
+    )
+
+
+def many_imports(n):
+    r"""
+    A file importing `n` modules and using a function and a global of each.
+    The modules do not exist: this measures parsing the imports and the
+    unresolved names only, see import_chain for resolution across modules.
+    """
+    lines = [f"import m{i};" for i in range(n)]
+    lines += [f"write(f{i}(c{i}));" for i in range(n)]
+    return "\n".join(lines) + "\n"
+
+
+def import_chain(n):
+    r"""
+    Returns {file name: source} of `n` modules, m{i} importing m{i-1}, and a
+    main.asy importing the last one.
+    """
+    files = {}
+    for i in range(n):
+        if i:
+            lines = [f"import m{i - 1};", f"real c{i} = c{i - 1} + 1;"]
+        else:
+            lines = ["real c0 = 0;"]
+        lines.append(f"real f{i}(real x) {{")
+        lines.append(f"  return x + c{i};")
+        lines.append("}")
+        files[f"m{i}.asy"] = "\n".join(lines) + "\n"
+    files["main.asy"] = f"import m{n - 1};\nwrite(f{n - 1}(c{n - 1}));\n"
+    return files
+
+
+AXES = {
+    "globals": many_globals,
+    "nesting": deep_nesting,
+    "long_lines": long_lines,
+    "arrays": array_initializers,
+    "imports": many_imports,
+}
+
+DEFAULT_SIZES = {
+    "globals": [100, 1000, 10000],
+    "nesting": [10, 50, 200],
+    "long_lines": [100, 1000, 10000],
+    "arrays": [100, 1000, 10000],
+    "imports": [10, 100, 1000],
+}
+
+
+def workloads(axes, sizes=None):
+    r"""
+    Yields (name, source) for every size of every axis, e.g.
+    ("globals-1000.asy", source).
+    """
+    for axis in axes:
+        for n in sizes or DEFAULT_SIZES[axis]:
+            yield f"{axis}-{n}.asy", AXES[axis](n)
+
+
+def parse_spec(spec):
+    r"""
+    Parses "axis" or "axis:size,size,..." into (axis, sizes or None).
+    """
+    axis, _, sizes = spec.partition(":")
+    if axis not in AXES:
+        raise ValueError(f"unknown workload axis {axis!r}")
+    return axis, [int(n) for n in sizes.split(",")] if sizes else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m server.parser.workload",
+        description="Writes synthetic Asymptote programs for scaling benchmarks.",
+    )
+    parser.add_argument(
+        "specs",
+        nargs="+",
+        metavar="AXIS[:N,N,...]",
+        help=f"one of {', '.join(AXES)} or chain, with sizes",
+    )
+    parser.add_argument("--output", default=".", help="directory to write to")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output, exist_ok=True)
+    for spec in args.specs:
+        axis, _, sizes = spec.partition(":")
+        if axis == "chain":
+            for n in [int(n) for n in sizes.split(",")] if sizes else [10]:
+                # one directory per chain, imports resolve to sibling files
+                directory = os.path.join(args.output, f"chain-{n}")
+                os.makedirs(directory, exist_ok=True)
+                for name, source in import_chain(n).items():
+                    with open(os.path.join(directory, name), "w") as f:
+                        f.write(source)
+            continue
+        axis, sizes = parse_spec(spec)
+        for name, source in workloads([axis], sizes):
+            with open(os.path.join(args.output, name), "w") as f:
+                f.write(source)
+
+
+if __name__ == "__main__":
+    main()
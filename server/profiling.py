@@ -0,0 +1,180 @@
+import cProfile
+import marshal
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+
+CPROFILE = "cprofile"
+SAMPLING = "sampling"
+MODES = (CPROFILE, SAMPLING)
+SAMPLING_INTERVAL_IN_SECONDS = 0.005
+
+
+def _label(code):
+    # the function key of pstats
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def _frame_name(label):
+    filename, line, name = label
+    return f"{os.path.basename(filename)}:{line}:{name}"
+
+
+class CProfileProfiler(object):
+    r"""
+    Deterministic profile of the thread calling start(), the event loop of
+    the server.
+    """
+
+    mode = CPROFILE
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, prefix):
+        self.profile.dump_stats(prefix + ".pstats")
+        stats = pstats.Stats(self.profile).stats
+        with open(prefix + ".collapsed", "w") as f:
+            for stack, microseconds in _call_graph_stacks(stats):
+                f.write(f"{';'.join(map(_frame_name, stack))} {microseconds}\n")
+
+
+def _call_graph_stacks(stats):
+    r"""
+    Yields (stack, self microseconds) unfolding the caller/callee graph of
+    cProfile from the functions without callers. The time of a function
+    called from several places is split in proportion of its callers.
+    """
+    callees = {}
+    for function, (_, _, _, _, callers) in stats.items():
+        for caller, (_, _, _, cumulative) in callers.items():
+            callees.setdefault(caller, []).append((function, cumulative))
+
+    roots = [f for f, (_, _, _, _, callers) in stats.items() if not callers]
+    stack = [(root, [root], stats[root][3]) for root in roots]
+    while stack:
+        function, path, cumulative = stack.pop()
+        total = stats[function][3]
+        share = cumulative / total if total else 0.0
+        children = 0.0
+        for callee, callee_time in callees.get(function, []):
+            if callee in path:
+                continue  # (recursion)
+            children += callee_time * share
+            stack.append((callee, path + [callee], callee_time * share))
+        own = int((cumulative - children) * 1e6)
+        if own > 0:
+            yield path, own
+
+
+class SamplingProfiler(object):
+    r"""
+    Samples the stack of the main thread every `interval` seconds of CPU
+    time with SIGPROF, or of wall time from a thread where there is no
+    SIGPROF or when not started from the main thread.
+    """
+
+    mode = SAMPLING
+
+    def __init__(self, interval=SAMPLING_INTERVAL_IN_SECONDS):
+        self.interval = interval
+        self.samples = {}  # (stack of labels, root first: count)
+        self.thread = None
+        self.previous_handler = None
+        self._stop = threading.Event()
+
+    def _sample(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append(_label(frame.f_code))
+            frame = frame.f_back
+        stack = tuple(reversed(stack))
+        self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def _on_signal(self, signum, frame):
+        self._sample(frame)
+
+    def _run(self, thread_id):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                self._sample(frame)
+
+    def start(self):
+        main = threading.main_thread()
+        if hasattr(signal, "setitimer") and threading.current_thread() is main:
+            self.previous_handler = signal.signal(signal.SIGPROF, self._on_signal)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            self.thread = threading.Thread(
+                target=self._run, args=(main.ident,), name="sampler", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+        else:
+            self._stop.set()
+            self.thread.join()
+
+    def write(self, prefix):
+        with open(prefix + ".collapsed", "w") as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{';'.join(map(_frame_name, stack))} {count}\n")
+        with open(prefix + ".pstats", "wb") as f:
+            marshal.dump(self.pstats(), f)
+
+    def pstats(self):
+        r"""
+        The samples as the statistics dict of pstats, in seconds.
+        """
+        stats = {}  # (label: [calls, calls, own time, cumulative time, callers])
+        for stack, count in self.samples.items():
+            seconds = count * self.interval
+            for label in set(stack):
+                entry = stats.setdefault(label, [0, 0, 0.0, 0.0, {}])
+                entry[0] += count
+                entry[1] += count
+                entry[3] += seconds
+            stats[stack[-1]][2] += seconds
+            for i, (caller, callee) in enumerate(zip(stack, stack[1:])):
+                own = seconds if i == len(stack) - 2 else 0.0
+                n, _, tt, ct = stats[callee][4].get(caller, (0, 0, 0.0, 0.0))
+                stats[callee][4][caller] = (
+                    n + count,
+                    n + count,
+                    tt + own,
+                    ct + seconds,
+                )
+        return {label: tuple(entry) for label, entry in stats.items()}
+
+
+def start(mode=CPROFILE, interval=SAMPLING_INTERVAL_IN_SECONDS):
+    profiler = SamplingProfiler(interval) if mode == SAMPLING else CProfileProfiler()
+    profiler.start()
+    profiler.started = time.time()
+    return profiler
+
+
+def stop(profiler, directory):
+    r"""
+    Stops `profiler` and writes its .pstats and .collapsed files in
+    `directory`. Returns their paths.
+    """
+    profiler.stop()
+    os.makedirs(directory, exist_ok=True)
+    name = time.strftime("%Y%m%d-%H%M%S", time.localtime(profiler.started))
+    prefix = os.path.join(directory, f"asy-lsp-{name}-{profiler.mode}")
+    profiler.write(prefix)
+    return prefix + ".pstats", prefix + ".collapsed"
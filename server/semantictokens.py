@@ -0,0 +1,102 @@
+from array import array
+from bisect import bisect_left
+
+token_types = ["namespace", "type", "struct", "function", "variable", "parameter"]
+token_modifiers = ["declaration"]
+
+DECLARATION = 1 << token_modifiers.index("declaration")
+
+# resolved token type -> (token type index, modifier bits)
+_encoding = {
+    "MODULE": (token_types.index("namespace"), 0),
+    "TYPE": (token_types.index("type"), 0),
+    "PARA_TYPE": (token_types.index("type"), 0),
+    "RETURN": (token_types.index("type"), 0),
+    "RECORD": (token_types.index("struct"), DECLARATION),
+    "VAR": (token_types.index("variable"), DECLARATION),
+    "FUNCTION": (token_types.index("function"), DECLARATION),
+    "PARAMETER": (token_types.index("parameter"), DECLARATION),
+    "USE_VAR": (token_types.index("variable"), 0),
+    "USE_FUNCTION": (token_types.index("function"), 0),
+    "USE_PARAMETER": (token_types.index("parameter"), 0),
+}
+
+
+class TokenArrays(object):
+    r"""
+    Column-wise copy of FileParsed.semantic_tokens, 0-based, in file order.
+    """
+
+    def __init__(self, semantic_tokens) -> None:
+        self.lines = array("I", (t[0] - 1 for t in semantic_tokens))
+        self.columns = array("I", (t[1] - 1 for t in semantic_tokens))
+        self.lengths = array("I", (t[2] for t in semantic_tokens))
+        self.types = array("I", (_encoding[t[3]][0] for t in semantic_tokens))
+        self.modifiers = array("I", (_encoding[t[3]][1] for t in semantic_tokens))
+        self.positions = [(t[0] - 1, t[1] - 1) for t in semantic_tokens]
+
+    def encode(self, start=0, end=None):
+        r"""
+        Returns the LSP relative encoding of tokens[start:end] as a flat array
+        of 5 integers per token.
+        """
+        lines = self.lines[start:end]
+        columns = self.columns[start:end]
+        count = len(lines)
+
+        delta_lines = array("I", [0]) * count
+        delta_columns = array("I", [0]) * count
+        if count:
+            delta_lines[0] = lines[0]
+            delta_columns[0] = columns[0]
+            delta_lines[1:] = array("I", map(int.__sub__, lines[1:], lines[:-1]))
+            # the column is relative to the previous token on the same line only
+            delta_columns[1:] = array(
+                "I",
+                (
+                    column - previous if not line_delta else column
+                    for line_delta, column, previous in zip(
+                        delta_lines[1:], columns[1:], columns[:-1]
+                    )
+                ),
+            )
+
+        data = array("I", [0]) * (5 * count)
+        data[0::5] = delta_lines
+        data[1::5] = delta_columns
+        data[2::5] = self.lengths[start:end]
+        data[3::5] = self.types[start:end]
+        data[4::5] = self.modifiers[start:end]
+        return data
+
+    def encode_range(self, start, end):
+        r"""
+        Encodes the tokens starting in [start, end), positions (line, column)
+        0-based.
+        """
+        return self.encode(
+            bisect_left(self.positions, start), bisect_left(self.positions, end)
+        )
+
+
+def _common_prefix(old, new, block=1024):
+    limit = min(len(old), len(new))
+    i = 0
+    while i + block <= limit and old[i : i + block] == new[i : i + block]:
+        i += block
+    while i < limit and old[i] == new[i]:
+        i += 1
+    return i
+
+
+def diff(old, new):
+    r"""
+    Returns the single (start, delete_count, data) edit turning `old` into
+    `new`, or None if they are equal.
+    """
+    prefix = _common_prefix(old, new)
+    if prefix == len(old) == len(new):
+        return None
+    limit = min(len(old), len(new)) - prefix
+    suffix = _common_prefix(old[::-1][:limit], new[::-1][:limit])
+    return prefix, len(old) - prefix - suffix, new[prefix : len(new) - suffix]
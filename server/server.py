@@ -15,24 +15,52 @@
 # limitations under the License.                                           #
 ############################################################################
 import asyncio
+import atexit
+import io
+import os
 import re
+import shutil
+import sys
+import tempfile
+import threading
 import time
+import tracemalloc
 import uuid
-from typing import Optional
+from typing import Any, List, Optional
+from .cache import DocumentCache, source_hash
+from .slowrequests import SLOW_REQUEST_BUNDLES, SlowRequests
+from .stats import STATS_DUMP_INTERVAL_IN_SECONDS, ServerStats
+from .tracing import Tracer
 from .parser.ast import FileParsed
 from pygls.uris import from_fs_path, to_fs_path
 
+from pygls.lsp import LSP_METHODS_MAP
 from pygls.lsp.methods import (
     COMPLETION,
+    INITIALIZE,
+    INITIALIZED,
     TEXT_DOCUMENT_DID_CHANGE,
     TEXT_DOCUMENT_DID_CLOSE,
     TEXT_DOCUMENT_DID_OPEN,
     DEFINITION,
+    DOCUMENT_HIGHLIGHT,
+    DOCUMENT_SYMBOL,
+    FOLDING_RANGE,
     FORMATTING,
+    ON_TYPE_FORMATTING,
+    PREPARE_RENAME,
     RANGE_FORMATTING,
+    REFERENCES,
+    RENAME,
+    TEXT_DOCUMENT_SEMANTIC_TOKENS_FULL,
+    TEXT_DOCUMENT_SEMANTIC_TOKENS_FULL_DELTA,
+    TEXT_DOCUMENT_SEMANTIC_TOKENS_RANGE,
+    WORKSPACE_DID_CHANGE_CONFIGURATION,
 )
 from pygls.lsp.types import (
+    ClientCapabilities,
     CompletionItem,
+    CompletionItemKind,
     CompletionList,
     CompletionOptions,
     CompletionParams,
@@ -41,108 +69,690 @@ from pygls.lsp.types import (
     Location,
     ConfigurationItem,
     ConfigurationParams,
+    DidChangeConfigurationParams,
     DidChangeTextDocumentParams,
     DidCloseTextDocumentParams,
     DidOpenTextDocumentParams,
+    Diagnostic,
+    DiagnosticSeverity,
     DocumentFormattingOptions,
+    DocumentHighlight,
+    DocumentHighlightKind,
+    DocumentHighlightParams,
+    DocumentOnTypeFormattingOptions,
+    DocumentOnTypeFormattingParams,
+    DocumentSymbol,
+    DocumentSymbolParams,
+    FoldingRange,
+    FoldingRangeParams,
+    InitializeParams,
     Position,
+    PrepareRename,
+    PrepareRenameParams,
     Range,
+    ReferenceParams,
+    RenameOptions,
+    RenameParams,
+    SemanticTokens,
+    SemanticTokensDelta,
+    SemanticTokensDeltaParams,
+    SemanticTokensEdit,
+    SemanticTokensLegend,
+    SemanticTokensParams,
+    SemanticTokensRangeParams,
+    SymbolKind,
+    TextDocumentClientCapabilities,
     TextEdit,
+    WorkspaceEdit,
 )
+from pygls.exceptions import JsonRpcInvalidParams, JsonRpcInvalidRequest
+from pygls.feature_manager import get_help_attrs
 
-from pygls.server import LanguageServer
+from pygls.protocol import LanguageServerProtocol, lsp_method
+from pygls.server import LanguageServer, StdOutTransportAdapter
 
+from . import memory, profiling, semantictokens
 from .completionitems import keywords_and_builtin_types
+from .parser.asylexer import keywords
+
+IDENTIFIER = re.compile(r"[a-zA-Z_][a-zA-Z_0-9]*")
 
 COUNT_DOWN_START_IN_SECONDS = 10
 COUNT_DOWN_SLEEP_IN_SECONDS = 1
+DIAGNOSTICS_DELAY_IN_SECONDS = 0.3
+
+TEXT_DOCUMENT_DIAGNOSTIC = "textDocument/diagnostic"
+TEXT_DOCUMENT_RANGES_FORMATTING = "textDocument/rangesFormatting"
+WORKSPACE_DIAGNOSTIC = "workspace/diagnostic"
+ASY_STATS = "asy/stats"
+ASY_MEMORY_REPORT = "asy/memoryReport"
+
+
+CONTENT_LENGTH = re.compile(rb"^Content-Length: (\d+)\r\n$")
+
+
+class AsyTextDocumentClientCapabilities(TextDocumentClientCapabilities):
+    # pull diagnostics are newer than the capabilities pygls knows about,
+    # undeclared fields would be dropped
+    diagnostic: Optional[Any] = None
+
+
+class AsyClientCapabilities(ClientCapabilities):
+    text_document: Optional[AsyTextDocumentClientCapabilities] = None
+
+
+class AsyInitializeParams(InitializeParams):
+    capabilities: AsyClientCapabilities
+
+
+LSP_METHODS_MAP[INITIALIZE] = (
+    None,
+    AsyInitializeParams,
+    LSP_METHODS_MAP[INITIALIZE][2],
+)
+
+
+class AsyLanguageServerProtocol(LanguageServerProtocol):
+    _received = 0.0  # (time the message being handled was received)
+    _arrived = None  # (time the reader got the data being handled, if known)
+    _method = None  # (method of the message being handled)
+
+    def message_arrived(self, data, arrived):
+        r"""
+        data_received for `data` read at `arrived`, before the event loop
+        could get to it.
+        """
+        self._arrived = arrived
+        try:
+            self.data_received(data)
+        finally:
+            self._arrived = None
+
+    def _procedure_handler(self, message):
+        self._received = self._arrived or time.perf_counter()
+        self._method = getattr(message, "method", None)
+        tracer = self._server.tracer
+        if tracer is not None:
+            args = {"id": getattr(message, "id", None)}
+            tracer.instant(f"receive {self._method}", self._received, "receive", args)
+        super()._procedure_handler(message)
+
+    def _send_data(self, data):
+        tracer = self._server.tracer
+        if tracer is None:
+            return super()._send_data(data)
+        with tracer.span("send", "serialize") as args:
+            args["id"] = getattr(data, "id", None)
+            args["method"] = getattr(data, "method", None)
+            super()._send_data(data)
+
+    def _execute_request(self, msg_id, handler, params):
+        method = self._method or get_help_attrs(handler)[0]
+        handler = self._server.stats.timed(method, handler, self._received)
+        super()._execute_request(msg_id, handler, params)
+
+    def _execute_notification(self, handler, *params):
+        # the builtin handler of a notification calls the user feature, only
+        # one of them is timed
+        method = self._method or get_help_attrs(handler)[0]
+        builtin = self.fm.builtin_features.get(method)
+        if handler is not builtin or method not in self.fm.features:
+            handler = self._server.stats.timed(method, handler, self._received)
+        super()._execute_notification(handler, *params)
+
+    @lsp_method(INITIALIZE)
+    def lsp_initialize(self, params):
+        result = super().lsp_initialize(params).dict(by_alias=True, exclude_none=True)
+        # pull diagnostics and multi-range formatting are newer than the
+        # capabilities pygls knows about
+        result["capabilities"]["diagnosticProvider"] = {
+            "identifier": "asy-lsp",
+            "interFileDependencies": True,
+            "workspaceDiagnostics": True,
+        }
+        result["capabilities"]["documentRangeFormattingProvider"] = {
+            "rangesSupport": True
+        }
+        return result
+
+    def _check_ret_type_and_send_response(
+        self, method_name, method_type, msg_id, result
+    ):
+        # no result type to check against for methods pygls does not know, or
+        # for results built as raw JSON (e.g. extended capabilities)
+        if method_name not in LSP_METHODS_MAP or isinstance(result, dict):
+            self._send_response(msg_id, result=result)
+            return
+        super()._check_ret_type_and_send_response(
+            method_name, method_type, msg_id, result
+        )
 
 
 class AsyLspServer(LanguageServer):
     CMD_SHOW_CONFIGURATION_ASYNC = "showConfigurationAsync"
     CMD_SHOW_CONFIGURATION_CALLBACK = "showConfigurationCallback"
     CMD_SHOW_CONFIGURATION_THREAD = "showConfigurationThread"
+    CMD_START_PROFILING = "asy/startProfiling"
+    CMD_STOP_PROFILING = "asy/stopProfiling"
 
     CONFIGURATION_SECTION = "asyServer"
 
+    def start_io(self, stdin=None, stdout=None):
+        r"""
+        Same as LanguageServer.start_io, but stdin is read by a thread of its
+        own instead of one message at a time from the event loop: a message
+        arriving while a handler blocks the loop gets its receive time, and
+        the queue wait in the statistics includes that handler.
+        """
+        self._stop_event = threading.Event()
+        stdin = stdin or sys.stdin.buffer
+        transport = StdOutTransportAdapter(stdin, stdout or sys.stdout.buffer)
+        self.lsp.connection_made(transport)
+        try:
+            # closing the transport on exit must not wait for the lock of
+            # the read in progress
+            rfile = os.fdopen(os.dup(stdin.fileno()), "rb")
+        except (OSError, ValueError, io.UnsupportedOperation):
+            rfile = stdin
+        closed = self.loop.create_future()
+        threading.Thread(
+            target=self._read_messages,
+            args=(rfile, closed),
+            name="stdin",
+            daemon=True,
+        ).start()
+        try:
+            self.loop.run_until_complete(closed)
+        except (BrokenPipeError, KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.shutdown()
+
+    def _read_messages(self, rfile, closed):
+        message = []
+        content_length = 0
+        try:
+            while not self._stop_event.is_set() and not rfile.closed:
+                header = rfile.readline()
+                if not header:
+                    break
+                message.append(header)
+                if not content_length:
+                    match = CONTENT_LENGTH.fullmatch(header)
+                    if match:
+                        content_length = int(match.group(1))
+                if content_length and not header.strip():
+                    body = rfile.read(content_length)
+                    if not body:
+                        break
+                    message.append(body)
+                    self.loop.call_soon_threadsafe(
+                        self.lsp.message_arrived,
+                        b"".join(message),
+                        time.perf_counter(),
+                    )
+                    message = []
+                    content_length = 0
+            self.loop.call_soon_threadsafe(closed.set_result, None)
+        except (OSError, ValueError, RuntimeError):
+            pass  # (stdin or the event loop closed while shutting down)
+
     def __init__(self):
-        super().__init__()
-        self.parsed_files = {}  # (fileuri:(fileparsed, time))
+        super().__init__(protocol_cls=AsyLanguageServerProtocol)
+        self.parsed_files = DocumentCache()  # (fileuri:(fileparsed, time))
+        self.parse_count = 0
         self.last_change_time = {}  # (fileuri: time)
+        self.edited_since_parse = {}  # (fileuri: first line changed since)
+        self.semantic_tokens = {}  # (fileuri: (result id, data))
+        self.pending_diagnostics = {}  # (fileuri: timer handle)
+        self.published_diagnostics = {}  # (fileuri: errors)
+        self.configuration = {}  # (asyServer setting: value)
+        self.stats = ServerStats()
+        self.tracer = None  # (tracing.Tracer, with --trace-file)
+        self.profiler = None  # (running profiling profiler)
+
+    @property
+    def formatter_engine(self):
+        engine = self.configuration.get("formatter")
+        return engine if engine in formatter.FORMATTERS else formatter.CLANG_FORMAT
+
+    async def update_configuration(self):
+        r"""
+        Pulls the asyServer settings, if the client supports
+        workspace/configuration.
+        """
+        workspace = self.client_capabilities.workspace
+        if workspace is None or not workspace.configuration:
+            return
+        try:
+            config = await self.get_configuration_async(
+                ConfigurationParams(
+                    items=[
+                        ConfigurationItem(
+                            scope_uri="", section=self.CONFIGURATION_SECTION
+                        )
+                    ]
+                )
+            )
+        except Exception as e:
+            self.show_message_log(f"Error ocurred: {e}")
+            return
+        self.apply_configuration(config[0] or {})
+
+    def apply_configuration(self, configuration):
+        self.configuration = configuration
+        budget = configuration.get("parsedDocumentsBudgetMB")
+        if isinstance(budget, (int, float)) and budget > 0:
+            self.parsed_files.budget = int(budget * 1024 * 1024)
+        spill_dir = self.parsed_files.spill_dir
+        if configuration.get("spillParsedDocuments"):
+            if spill_dir is None:
+                # private to this process: spilled parses are unpickled
+                spill_dir = tempfile.mkdtemp(prefix="asy-lsp-parsed-")
+                atexit.register(shutil.rmtree, spill_dir, True)
+                self.parsed_files.spill_dir = spill_dir
+        elif spill_dir is not None:
+            shutil.rmtree(spill_dir, True)
+            self.parsed_files.spill_dir = None
+        self.parsed_files.evict()
+
+        if self.stats.slow_requests is not None:
+            self.stats.slow_requests.close()
+            self.stats.slow_requests = None
+        threshold = configuration.get("slowRequestThresholdMs")
+        if isinstance(threshold, (int, float)) and threshold > 0:
+            directory = configuration.get("slowRequestDirectory") or os.path.join(
+                tempfile.gettempdir(), "asy-lsp", "slow-requests"
+            )
+            keep = configuration.get("slowRequestBundles")
+            self.stats.slow_requests = SlowRequests(
+                self,
+                directory,
+                threshold / 1000,
+                keep if isinstance(keep, int) and keep > 0 else SLOW_REQUEST_BUNDLES,
+            )
+
+    def dump_stats_periodically(self, path, interval=STATS_DUMP_INTERVAL_IN_SECONDS):
+        r"""
+        Writes the statistics as Prometheus text to `path` every `interval`
+        seconds.
+        """
+
+        def dump():
+            try:
+                self.stats.dump(path)
+            except OSError:
+                pass  # (tried again at the next interval)
+            self.loop.call_later(interval, dump)
+
+        self.loop.call_later(interval, dump)
+
+    def start_tracing(self, path):
+        self.tracer = self.stats.tracer = Tracer(path)
+        atexit.register(self.tracer.close)
+
+    def _trace_lexer(self, lexer):
+        # lexing is interleaved with parsing, its time is summed up
+        token = lexer.token
+        lexed = [0.0, 0]  # (seconds, tokens)
+
+        def timed_token():
+            start = time.perf_counter()
+            result = token()
+            lexed[0] += time.perf_counter() - start
+            lexed[1] += 1
+            return result
+
+        lexer.token = timed_token
+        return lexed
+
+    def _trace_parse(self, file_uri, start, built, parsed, resolved, lexed):
+        args = {"uri": file_uri}
+        self.tracer.complete("setup", start, built, "parse", args)
+        self.tracer.complete("parse", built, parsed, "parse", args)
+        self.tracer.complete(
+            "lex",
+            built,
+            built + lexed[0],
+            "parse",
+            {"uri": file_uri, "tokens": lexed[1], "summed": True},
+        )
+        self.tracer.complete("resolve", parsed, resolved, "parse", args)
 
     def parse_file(self, file_uri):
         file_path = to_fs_path(file_uri)
-        file = FileParsed(file_path)
-        file.parse()
-        file.construct_jump_table()
+        document = self.workspace.get_document(file_uri)
+        self.edited_since_parse.pop(file_uri, None)
+        entry = self.parsed_files.restore(file_uri, document.source)
+        if entry is not None:
+            file = entry[0]
+        else:
+            start = time.perf_counter()
+            file = FileParsed(file_path)
+            self.parse_count += 1
+            file.generation = self.parse_count
+            file.source_hash = source_hash(document.source)
+            if self.tracer is not None:
+                lexed = self._trace_lexer(file.lexer)
+            built = time.perf_counter()
+            file.parse(document.source)
+            parsed = time.perf_counter()
+            file.construct_jump_table()
+            file.release_parser()
+            resolved = time.perf_counter()
+            self.stats.observe_stage("setup", built - start)
+            self.stats.observe_stage("parse", parsed - built)
+            self.stats.observe_stage("resolve", resolved - parsed)
+            if self.tracer is not None:
+                self._trace_parse(file_uri, start, built, parsed, resolved, lexed)
+        file.version = document.version
         self.parsed_files[file_uri] = (file, time.time())
         return file
 
+    def get_parsed(self, file_uri):
+        if file_uri not in self.parsed_files:
+            return self.parse_file(file_uri)
+
+        file, last_time = self.parsed_files[file_uri]
+        if last_time < self.last_change_time.get(file_uri, 0):
+            file = self.parse_file(file_uri)
+        return file
+
+    def get_cached(self, file_uri, name, compute):
+        r"""
+        Returns `compute(file)` for the current parse of `file_uri`, computed
+        once per parse.
+        """
+        file = self.get_parsed(file_uri)
+        if name not in file.cache.keys():
+            file.cache[name] = compute(file)
+        return file.cache[name]
+
+    def schedule_diagnostics(self, file_uri):
+        r"""
+        Publishes the diagnostics of `file_uri` once it stops changing for
+        DIAGNOSTICS_DELAY_IN_SECONDS. Each call postpones the previous one, so
+        a burst of changes is published once, for the latest version.
+        """
+        handle = self.pending_diagnostics.pop(file_uri, None)
+        if handle is not None:
+            handle.cancel()
+        version = self.workspace.get_document(file_uri).version
+        self.pending_diagnostics[file_uri] = self.loop.call_later(
+            DIAGNOSTICS_DELAY_IN_SECONDS,
+            self.publish_file_diagnostics,
+            file_uri,
+            version,
+        )
+
+    def publish_file_diagnostics(self, file_uri, version=None):
+        self.pending_diagnostics.pop(file_uri, None)
+        if version is not None and (
+            version != self.workspace.get_document(file_uri).version
+        ):
+            return
+
+        errors = self.get_parsed(file_uri).errors
+        if self.published_diagnostics.get(file_uri) == errors:
+            return
+        self.published_diagnostics[file_uri] = errors
+        self.publish_diagnostics(file_uri, to_diagnostics(errors))
+
+    def clear_diagnostics(self, file_uri):
+        handle = self.pending_diagnostics.pop(file_uri, None)
+        if handle is not None:
+            handle.cancel()
+        if self.published_diagnostics.pop(file_uri, None):
+            self.publish_diagnostics(file_uri, [])
+
+    @property
+    def pulls_diagnostics(self):
+        r"""
+        Whether the client pulls diagnostics, in which case none are pushed.
+        """
+        capabilities = getattr(self.lsp, "client_capabilities", None)
+        text_document = getattr(capabilities, "text_document", None)
+        return getattr(text_document, "diagnostic", None) is not None
+
+    def diagnostics_report(self, file_uri, previous_result_id=None):
+        r"""
+        Returns a pull diagnostics report. The result id changes whenever the
+        file or one of its imports, direct or not, is reparsed; an unchanged
+        report is returned if it matches `previous_result_id`.
+        """
+        file = self.get_parsed(file_uri)
+        generations = []
+        pending = [file_uri]
+        visited = {file_uri}
+        while pending:
+            uri = pending.pop()
+            imported = file if uri == file_uri else self.get_parsed(uri)
+            generations.append(imported.generation)
+            for module in imported.imported_files:
+                module_uri = self.resolve_import(uri, module)
+                if module_uri is not None and module_uri not in visited:
+                    visited.add(module_uri)
+                    pending.append(module_uri)
+        result_id = "-".join(str(g) for g in generations)
+
+        if result_id == previous_result_id:
+            return {"kind": "unchanged", "resultId": result_id}
+        return {
+            "kind": "full",
+            "resultId": result_id,
+            "items": to_diagnostics(file.errors),
+        }
+
+    def resolve_import(self, file_uri, module):
+        r"""
+        Returns the uri of `module` imported from `file_uri`. Only modules next
+        to the importing file are resolved.
+        """
+        module_path = os.path.join(
+            os.path.dirname(to_fs_path(file_uri)), module + ".asy"
+        )
+        if not os.path.isfile(module_path):
+            return None
+        return from_fs_path(module_path)
+
+    def find_declaration(self, file_uri, line, column):
+        r"""
+        Returns (uri, declaration token) of the symbol under (line, column),
+        following imports for names not declared in the file itself.
+        """
+        file = self.get_parsed(file_uri)
+        pos = file.find_declaration(line, column)
+        if pos is not None:
+            return file_uri, file.declarations[pos]
+
+        name = file.find_unresolved(line, column)
+        if name is None:
+            return None
+        for module in file.imported_files:
+            module_uri = self.resolve_import(file_uri, module)
+            if module_uri is None:
+                continue
+            dec = self.get_parsed(module_uri).find_exported(name)
+            if dec is not None:
+                return module_uri, dec
+        return None
+
+    def find_references(self, dec_uri, dec):
+        r"""
+        Returns {uri: [(line, column_start, column_end)]} of the uses of `dec`.
+        Global declarations are also looked up in the parsed files importing
+        `dec_uri`.
+        """
+        file = self.get_parsed(dec_uri)
+        result = {dec_uri: list(file.references.get(dec["position"], []))}
+        if file.find_exported(dec["value"]) is not dec:
+            return result
+
+        for uri in list(self.parsed_files.keys()):
+            if uri == dec_uri:
+                continue
+            other = self.get_parsed(uri)
+            spans = other.unresolved_references.get(dec["value"])
+            if not spans:
+                continue
+            for module in other.imported_files:
+                if self.resolve_import(uri, module) == dec_uri:
+                    result[uri] = list(spans)
+                    break
+        return result
+
+
+def span_to_range(span):
+    line, column_start, column_end = span
+    return Range(
+        start=Position(line=line - 1, character=column_start - 1),
+        end=Position(line=line - 1, character=column_end - 1),
+    )
+
+
+def declaration_span(dec):
+    line, column = dec["position"]
+    return (line, column, column + dec["len"])
+
+
+def to_text_edits(edits):
+    return [
+        TextEdit(
+            range=Range(
+                start=Position(line=start_line, character=start_character),
+                end=Position(line=end_line, character=end_character),
+            ),
+            new_text=new_text,
+        )
+        for start_line, start_character, end_line, end_character, new_text in edits
+    ]
+
+
+def to_diagnostics(errors):
+    return [
+        Diagnostic(
+            range=span_to_range((line, column, column + length)),
+            severity=DiagnosticSeverity.Error,
+            source="asy-lsp",
+            message=message,
+        )
+        for message, (line, column), length in errors
+    ]
+
 
 asy_lsp_server = AsyLspServer()
 
 from . import formatter
 
 
-@asy_lsp_server.feature(RANGE_FORMATTING)
-def range_formatting(params):
-    dst_uri = params.text_document.uri
-    file_path = to_fs_path(dst_uri)
-    start_line, start_column = (
-        params.range.start.line + 1,
-        params.range.start.character + 1,
-    )
-    end_line, end_column = params.range.end.line + 1, params.range.end.character + 1
+def _line_range(range):
+    # a selection ending at the start of a line does not include that line
+    end_line = range.end.line
+    if range.end.character == 0 and end_line > range.start.line:
+        end_line -= 1
+    return range.start.line, end_line
+
 
-    formatted_text = formatter.format_code_range(
-        file_path, start_line, start_column, end_line, end_column
+async def _format_ranges(dst_uri, ranges):
+    document = asy_lsp_server.workspace.get_document(dst_uri)
+    edits = await formatter.format_ranges_edits_async(
+        document.source,
+        [_line_range(range) for range in ranges],
+        asy_lsp_server.formatter_engine,
     )
 
-    if formatted_text is not None:
-        return [TextEdit(range=params.range, new_text=formatted_text)]
+    if edits is not None:
+        return to_text_edits(edits)
     return None
 
 
+@asy_lsp_server.feature(RANGE_FORMATTING)
+async def range_formatting(params):
+    return await _format_ranges(params.text_document.uri, [params.range])
+
+
+@asy_lsp_server.feature(TEXT_DOCUMENT_RANGES_FORMATTING)
+async def ranges_formatting(params):
+    return await _format_ranges(params.textDocument.uri, params.ranges)
+
+
 @asy_lsp_server.feature(
     FORMATTING,
     DocumentFormattingOptions(),
 )
-def formatting(params):
+async def formatting(params):
     dst_uri = params.text_document.uri
-    file_path = to_fs_path(dst_uri)
-    formatted_text = formatter.format_code(file_path)
-
-    if formatted_text is not None:
-        return [
-            TextEdit(
-                range=Range(
-                    start=Position(line=0, character=0),
-                    end=Position(line=999999, character=999999),
-                ),
-                new_text=formatted_text,
-            )
-        ]
+    document = asy_lsp_server.workspace.get_document(dst_uri)
+    edits = await formatter.format_edits_async(
+        document.source, asy_lsp_server.formatter_engine
+    )
+
+    if edits is not None:
+        return to_text_edits(edits)
     return None
 
 
+@asy_lsp_server.feature(
+    ON_TYPE_FORMATTING,
+    DocumentOnTypeFormattingOptions(
+        first_trigger_character=";", more_trigger_character=["}"]
+    ),
+)
+def on_type_formatting(params: DocumentOnTypeFormattingParams):
+    # always the native engine: no process spawn per keystroke
+    uri = params.text_document.uri
+    document = asy_lsp_server.workspace.get_document(uri)
+    # the last parse, not parsed again per keystroke, only gives where
+    # lexing can start
+    starts = ()
+    entry = asy_lsp_server.parsed_files.get(uri)
+    if entry is not None:
+        file = entry[0]
+        if ON_TYPE_FORMATTING not in file.cache:
+            file.cache[ON_TYPE_FORMATTING] = formatter.statement_starts(file.all_tokens)
+        starts = file.cache[ON_TYPE_FORMATTING]
+    return to_text_edits(
+        formatter.format_on_type_edits(
+            document.source,
+            params.position.line,
+            starts,
+            asy_lsp_server.edited_since_parse.get(uri),
+        )
+    )
+
+
+COMPLETION_KINDS = {
+    "VAR": CompletionItemKind.Variable,
+    "PARAMETER": CompletionItemKind.Variable,
+    "FUNCTION": CompletionItemKind.Function,
+    "RECORD": CompletionItemKind.Struct,
+}
+
+
 @asy_lsp_server.feature(COMPLETION, CompletionOptions())
 def completions(params: Optional[CompletionParams] = None) -> CompletionList:
     """Returns completion items."""
-    return CompletionList(
-        is_incomplete=False,
-        items=[CompletionItem(label=item) for item in keywords_and_builtin_types],
+    items = []
+    if params is not None:
+        file = asy_lsp_server.get_parsed(params.text_document.uri)
+        line, column = params.position.line + 1, params.position.character + 1
+        items = [
+            CompletionItem(label=item["value"], kind=COMPLETION_KINDS[item["type"]])
+            for item in file.visible_declarations(line, column)
+        ]
+    labels = {item.label for item in items}
+    items.extend(
+        CompletionItem(label=item)
+        for item in keywords_and_builtin_types
+        if item not in labels
     )
+    return CompletionList(is_incomplete=False, items=items)
 
 
 @asy_lsp_server.feature(DEFINITION, DefinitionOptions())
 def defitions(params: DefinitionParams) -> Optional[Location]:
     dst_uri = params.text_document.uri
-    if dst_uri not in asy_lsp_server.parsed_files.keys():
-        asy_lsp_server.parse_file(dst_uri)
-
-    file, last_time = asy_lsp_server.parsed_files[dst_uri]
-    if last_time < asy_lsp_server.last_change_time[dst_uri]:
-        file = asy_lsp_server.parse_file(dst_uri)
+    file = asy_lsp_server.get_parsed(dst_uri)
 
     line, column = params.position.line + 1, params.position.character + 1
     pos = file.find_definiton(line, column)
@@ -159,28 +769,334 @@ def defitions(params: DefinitionParams) -> Optional[Location]:
     return None
 
 
+@asy_lsp_server.feature(REFERENCES)
+def references(params: ReferenceParams) -> Optional[List[Location]]:
+    dst_uri = params.text_document.uri
+    line, column = params.position.line + 1, params.position.character + 1
+    found = asy_lsp_server.find_declaration(dst_uri, line, column)
+    if found is None:
+        return None
+
+    dec_uri, dec = found
+    locations = []
+    if params.context.include_declaration:
+        locations.append(
+            Location(uri=dec_uri, range=span_to_range(declaration_span(dec)))
+        )
+    for uri, spans in asy_lsp_server.find_references(dec_uri, dec).items():
+        locations.extend(Location(uri=uri, range=span_to_range(span)) for span in spans)
+    return locations
+
+
+@asy_lsp_server.feature(DOCUMENT_HIGHLIGHT)
+def document_highlight(
+    params: DocumentHighlightParams,
+) -> Optional[List[DocumentHighlight]]:
+    dst_uri = params.text_document.uri
+    file = asy_lsp_server.get_parsed(dst_uri)
+    line, column = params.position.line + 1, params.position.character + 1
+
+    pos = file.find_declaration(line, column)
+    if pos is not None:
+        dec = file.declarations[pos]
+        spans = file.references.get(pos, [])
+        highlights = [
+            DocumentHighlight(
+                range=span_to_range(declaration_span(dec)),
+                kind=DocumentHighlightKind.Write,
+            )
+        ]
+    else:
+        # a name coming from an imported module
+        name = file.find_unresolved(line, column)
+        if name is None:
+            return None
+        spans = file.unresolved_references.get(name, [])
+        highlights = []
+
+    highlights.extend(
+        DocumentHighlight(range=span_to_range(span), kind=DocumentHighlightKind.Read)
+        for span in spans
+    )
+    return highlights
+
+
+def _rename_target(dst_uri, position):
+    line, column = position.line + 1, position.character + 1
+    found = asy_lsp_server.find_declaration(dst_uri, line, column)
+    if found is None:
+        return None, None, None
+
+    dec_uri, dec = found
+    spans = asy_lsp_server.find_references(dec_uri, dec)
+    spans.setdefault(dec_uri, []).append(declaration_span(dec))
+    for span in spans.get(dst_uri, []):
+        if span[0] == line and span[1] <= column <= span[2]:
+            return dec, span, spans
+    return None, None, None
+
+
+@asy_lsp_server.feature(PREPARE_RENAME)
+def prepare_rename(params: PrepareRenameParams) -> Optional[PrepareRename]:
+    dec, span, _ = _rename_target(params.text_document.uri, params.position)
+    if dec is None:
+        return None
+    return PrepareRename(range=span_to_range(span), placeholder=dec["value"])
+
+
+@asy_lsp_server.feature(RENAME, RenameOptions(prepare_provider=True))
+def rename(params: RenameParams) -> Optional[WorkspaceEdit]:
+    new_name = params.new_name
+    if not IDENTIFIER.fullmatch(new_name) or new_name in keywords:
+        raise JsonRpcInvalidParams(f"'{new_name}' is not a valid identifier")
+
+    dec, _, spans = _rename_target(params.text_document.uri, params.position)
+    if dec is None:
+        return None
+
+    return WorkspaceEdit(
+        changes={
+            uri: [
+                TextEdit(range=span_to_range(span), new_text=new_name)
+                for span in sorted(set(uri_spans))
+            ]
+            for uri, uri_spans in spans.items()
+        }
+    )
+
+
+SYMBOL_KINDS = {
+    "VAR": SymbolKind.Variable,
+    "FUNCTION": SymbolKind.Function,
+    "RECORD": SymbolKind.Struct,
+}
+MEMBER_KINDS = {
+    "VAR": SymbolKind.Field,
+    "FUNCTION": SymbolKind.Method,
+    "RECORD": SymbolKind.Struct,
+}
+
+
+def _document_symbols(items, kinds=SYMBOL_KINDS):
+    symbols = []
+    for item, children in items:
+        selection_range = span_to_range(declaration_span(item))
+        symbol_range = selection_range
+        if "body" in item and item["body"].end[0] > 0:
+            end_line, end_column = item["body"].end
+            symbol_range = Range(
+                start=selection_range.start,
+                end=Position(line=end_line - 1, character=end_column),
+            )
+        symbols.append(
+            DocumentSymbol(
+                name=item["value"],
+                kind=kinds[item["type"]],
+                range=symbol_range,
+                selection_range=selection_range,
+                children=_document_symbols(
+                    children,
+                    MEMBER_KINDS if item["type"] == "RECORD" else SYMBOL_KINDS,
+                ),
+            )
+        )
+    return symbols
+
+
+@asy_lsp_server.feature(DOCUMENT_SYMBOL)
+def document_symbol(params: DocumentSymbolParams) -> List[DocumentSymbol]:
+    return asy_lsp_server.get_cached(
+        params.text_document.uri,
+        DOCUMENT_SYMBOL,
+        lambda file: _document_symbols(file.outline()),
+    )
+
+
+@asy_lsp_server.feature(FOLDING_RANGE)
+def folding_range(params: FoldingRangeParams) -> List[FoldingRange]:
+    # keep the line of the closing brace visible
+    return asy_lsp_server.get_cached(
+        params.text_document.uri,
+        FOLDING_RANGE,
+        lambda file: [
+            FoldingRange(start_line=start - 1, end_line=end - 2)
+            for start, end in file.folding_ranges()
+            if end - 2 > start - 1
+        ],
+    )
+
+
+SEMANTIC_TOKENS_LEGEND = SemanticTokensLegend(
+    token_types=semantictokens.token_types,
+    token_modifiers=semantictokens.token_modifiers,
+)
+
+
+def _token_arrays(file_uri):
+    return asy_lsp_server.get_cached(
+        file_uri,
+        TEXT_DOCUMENT_SEMANTIC_TOKENS_FULL,
+        lambda file: semantictokens.TokenArrays(file.semantic_tokens),
+    )
+
+
+def _save_semantic_tokens(file_uri, data):
+    result_id = uuid.uuid4().hex
+    asy_lsp_server.semantic_tokens[file_uri] = (result_id, data)
+    return result_id
+
+
+@asy_lsp_server.feature(TEXT_DOCUMENT_SEMANTIC_TOKENS_FULL, SEMANTIC_TOKENS_LEGEND)
+def semantic_tokens_full(params: SemanticTokensParams) -> SemanticTokens:
+    dst_uri = params.text_document.uri
+    data = _token_arrays(dst_uri).encode()
+    result_id = _save_semantic_tokens(dst_uri, data)
+    return SemanticTokens(data=data.tolist(), result_id=result_id)
+
+
+@asy_lsp_server.feature(
+    TEXT_DOCUMENT_SEMANTIC_TOKENS_FULL_DELTA, SEMANTIC_TOKENS_LEGEND
+)
+def semantic_tokens_delta(params: SemanticTokensDeltaParams):
+    dst_uri = params.text_document.uri
+    previous_id, previous = asy_lsp_server.semantic_tokens.get(dst_uri, (None, None))
+    data = _token_arrays(dst_uri).encode()
+    result_id = _save_semantic_tokens(dst_uri, data)
+
+    if previous_id != params.previous_result_id:
+        return SemanticTokens(data=data.tolist(), result_id=result_id)
+
+    edit = semantictokens.diff(previous, data)
+    edits = []
+    if edit is not None:
+        start, delete_count, new_data = edit
+        edits.append(
+            SemanticTokensEdit(
+                start=start, delete_count=delete_count, data=new_data.tolist()
+            )
+        )
+    return SemanticTokensDelta(edits=edits, result_id=result_id)
+
+
+@asy_lsp_server.feature(TEXT_DOCUMENT_SEMANTIC_TOKENS_RANGE, SEMANTIC_TOKENS_LEGEND)
+def semantic_tokens_range(params: SemanticTokensRangeParams) -> SemanticTokens:
+    start, end = params.range.start, params.range.end
+    data = _token_arrays(params.text_document.uri).encode_range(
+        (start.line, start.character), (end.line, end.character)
+    )
+    return SemanticTokens(data=data.tolist())
+
+
+@asy_lsp_server.feature(TEXT_DOCUMENT_DIAGNOSTIC)
+def document_diagnostic(params):
+    return asy_lsp_server.diagnostics_report(
+        params.textDocument.uri, getattr(params, "previousResultId", None)
+    )
+
+
+@asy_lsp_server.feature(WORKSPACE_DIAGNOSTIC)
+def workspace_diagnostic(params):
+    previous_result_ids = {
+        item.uri: item.value for item in getattr(params, "previousResultIds", [])
+    }
+    items = []
+    for uri in list(asy_lsp_server.parsed_files.keys()):
+        report = asy_lsp_server.diagnostics_report(uri, previous_result_ids.get(uri))
+        report["uri"] = uri
+        report["version"] = asy_lsp_server.get_parsed(uri).version
+        items.append(report)
+    return {"items": items}
+
+
+@asy_lsp_server.feature(ASY_STATS)
+def stats(params):
+    result = asy_lsp_server.stats.to_dict()
+    result["parse_count"] = asy_lsp_server.parse_count
+    result["parsed_documents"] = len(asy_lsp_server.parsed_files)
+    return result
+
+
+@asy_lsp_server.feature(ASY_MEMORY_REPORT)
+def memory_report(params):
+    # (params: {uri, top}, both optional)
+    parsed_files = asy_lsp_server.parsed_files
+    # read without touching the least recently used order
+    documents = {
+        uri: memory.document_report(file)
+        for uri, (file, _) in list(parsed_files.entries.items())
+    }
+    result = {
+        "total": sum(report["total"] for report in documents.values()),
+        "budget": parsed_files.budget,
+        "evictions": parsed_files.evictions,
+        "documents": documents,
+    }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        result["traced"] = {"current": current, "peak": peak}
+
+    uri = getattr(params, "uri", None)
+    if uri is not None:
+        document = asy_lsp_server.workspace.get_document(uri)
+        result["parse"] = memory.parse_allocations(
+            to_fs_path(uri),
+            document.source,
+            getattr(params, "top", None) or memory.HOT_SPOTS,
+        )
+    return result
+
+
 @asy_lsp_server.feature(TEXT_DOCUMENT_DID_CHANGE)
 def did_change(ls, params: DidChangeTextDocumentParams):
     """Text document did change notification."""
     dst_uri = params.text_document.uri
     asy_lsp_server.last_change_time[dst_uri] = time.time()
+    edited = asy_lsp_server.edited_since_parse
+    for change in params.content_changes:
+        change_range = getattr(change, "range", None)
+        line = change_range.start.line if change_range is not None else 0
+        edited[dst_uri] = min(edited.get(dst_uri, line), line)
+    if not asy_lsp_server.pulls_diagnostics:
+        asy_lsp_server.schedule_diagnostics(dst_uri)
 
 
 @asy_lsp_server.feature(TEXT_DOCUMENT_DID_CLOSE)
 def did_close(server: AsyLspServer, params: DidCloseTextDocumentParams):
     """Text document did close notification."""
+    file_uri = params.text_document.uri
+    server.clear_diagnostics(file_uri)
+    server.parsed_files.close(file_uri)
+    server.last_change_time.pop(file_uri, None)
+    server.edited_since_parse.pop(file_uri, None)
+    server.semantic_tokens.pop(file_uri, None)
     server.show_message("Text Document Did Close")
 
 
 @asy_lsp_server.feature(TEXT_DOCUMENT_DID_OPEN)
 async def did_open(ls, params: DidOpenTextDocumentParams):
     file_uri = params.text_document.uri
-    if file_uri not in asy_lsp_server.parsed_files.keys():
-        asy_lsp_server.parse_file(file_uri)
+    asy_lsp_server.parsed_files.open(file_uri)
     asy_lsp_server.last_change_time[file_uri] = time.time()
+    asy_lsp_server.parse_file(file_uri)
+    if not asy_lsp_server.pulls_diagnostics:
+        asy_lsp_server.publish_file_diagnostics(file_uri)
     ls.show_message("Text Document Did Open")
 
 
+@asy_lsp_server.feature(INITIALIZED)
+async def initialized(ls, params):
+    await ls.update_configuration()
+
+
+@asy_lsp_server.feature(WORKSPACE_DID_CHANGE_CONFIGURATION)
+async def did_change_configuration(ls, params: DidChangeConfigurationParams):
+    settings = params.settings
+    if isinstance(settings, dict) and AsyLspServer.CONFIGURATION_SECTION in settings:
+        ls.apply_configuration(settings[AsyLspServer.CONFIGURATION_SECTION] or {})
+    else:
+        await ls.update_configuration()
+
+
 @asy_lsp_server.command(AsyLspServer.CMD_SHOW_CONFIGURATION_ASYNC)
 async def show_configuration_async(ls: AsyLspServer, *args):
     """Gets exampleConfiguration from the client settings using coroutines."""
@@ -249,3 +1165,40 @@ def show_configuration_thread(ls: AsyLspServer, *args):
 
     except Exception as e:
         ls.show_message_log(f"Error ocurred: {e}")
+
+
+def _command_options(args):
+    # the first argument of a command, an object of options that pygls turns
+    # into a namedtuple
+    options = args[0] if args else None
+    if hasattr(options, "_asdict"):
+        return options._asdict()
+    return options if isinstance(options, dict) else {}
+
+
+@asy_lsp_server.command(AsyLspServer.CMD_START_PROFILING)
+def start_profiling(ls: AsyLspServer, args):
+    """Profiles the running server, deterministically or by sampling."""
+    if ls.profiler is not None:
+        raise JsonRpcInvalidRequest("Already profiling")
+    options = _command_options(args)
+    mode = options.get("mode", profiling.CPROFILE)
+    if mode not in profiling.MODES:
+        raise JsonRpcInvalidParams(f"Unknown profiling mode '{mode}'")
+    interval = options.get("interval", profiling.SAMPLING_INTERVAL_IN_SECONDS)
+    ls.profiler = profiling.start(mode, interval)
+    return {"mode": ls.profiler.mode}
+
+
+@asy_lsp_server.command(AsyLspServer.CMD_STOP_PROFILING)
+def stop_profiling(ls: AsyLspServer, args):
+    """Stops profiling and writes the .pstats and .collapsed files."""
+    if ls.profiler is None:
+        raise JsonRpcInvalidRequest("Not profiling")
+    directory = _command_options(args).get("directory") or os.path.join(
+        tempfile.gettempdir(), "asy-lsp", "profiles"
+    )
+    profiler, ls.profiler = ls.profiler, None
+    pstats_path, collapsed_path = profiling.stop(profiler, directory)
+    ls.show_message(f"Profile written to {pstats_path}")
+    return {"pstats": pstats_path, "collapsed": collapsed_path}
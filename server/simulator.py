@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from pygls.lsp.methods import COMPLETION, DEFINITION
+from pygls.lsp.types import (
+    ClientCapabilities,
+    CompletionParams,
+    DefinitionParams,
+    DidChangeTextDocumentParams,
+    DidCloseTextDocumentParams,
+    DidOpenTextDocumentParams,
+    InitializeParams,
+    Position,
+    Range,
+    TextDocumentContentChangeEvent,
+    TextDocumentIdentifier,
+    TextDocumentItem,
+    VersionedTextDocumentIdentifier,
+)
+from pygls.uris import from_fs_path
+
+from .loadtest import _percentile
+from .server import asy_lsp_server
+
+KEYSTROKES = 200
+KEYSTROKE_INTERVAL_IN_SECONDS = 0.05
+REQUEST_EVERY = 5  # keystrokes between two definition and completion requests
+FRESH_RESULT_TIMEOUT_IN_SECONDS = 10
+
+
+class _Transport(object):
+    # stands for the editor: counts what the server sends
+    def __init__(self):
+        self.messages = {}  # (method or "response": count)
+
+    def write(self, data):
+        body = json.loads(data.partition(b"\r\n\r\n")[2] or data)
+        method = body.get("method", "response")
+        self.messages[method] = self.messages.get(method, 0) + 1
+
+    def close(self):
+        pass
+
+
+def typing_edits(source, line=None, keystrokes=KEYSTROKES):
+    r"""
+    Cuts `keystrokes` characters of `source` from the start of `line`,
+    0-based, the middle line by default. Returns (source without them,
+    [(line, character, typed character)]) to type them back one by one.
+    """
+    lines = source.split("\n")
+    if line is None:
+        line = len(lines) // 2
+    line = max(0, min(line, len(lines) - 1))
+    start = sum(len(l) + 1 for l in lines[:line])
+    typed = source[start : start + keystrokes]
+
+    edits = []
+    character = 0
+    for c in typed:
+        edits.append((line, character, c))
+        if c == "\n":
+            line, character = line + 1, 0
+        else:
+            character += len(c.encode("utf-16-le")) // 2
+    return source[:start] + source[start + len(typed) :], edits
+
+
+def _distribution(values):
+    return {
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": _percentile(values, 50),
+        "p90": _percentile(values, 90),
+        "p99": _percentile(values, 99),
+        "max": max(values, default=0.0),
+    }
+
+
+def simulate(
+    path,
+    line=None,
+    keystrokes=KEYSTROKES,
+    interval=KEYSTROKE_INTERVAL_IN_SECONDS,
+    request_every=REQUEST_EVERY,
+    configuration=None,
+    trace_memory=False,
+):
+    r"""
+    Types `keystrokes` characters of the .asy file at `path` back into it,
+    one didChange each `interval` seconds, through the handlers of the
+    server in this process, with a definition and a completion request every
+    `request_every` keystrokes. Returns the report as a dict.
+    """
+    server = asy_lsp_server
+    with open(path) as f:
+        source = f.read()
+    initial, edits = typing_edits(source, line, keystrokes)
+
+    transport = _Transport()
+    previous_transport = server.lsp.transport
+    server.lsp.connection_made(transport)
+    server.lsp.lsp_initialize(
+        InitializeParams(
+            process_id=None,
+            root_uri=from_fs_path(os.path.dirname(os.path.abspath(path))),
+            capabilities=ClientCapabilities(),
+        )
+    )
+    server.apply_configuration(configuration or {})
+    try:
+        report = server.loop.run_until_complete(
+            _type(
+                server,
+                from_fs_path(os.path.abspath(path)),
+                initial,
+                edits,
+                interval,
+                request_every,
+                trace_memory,
+            )
+        )
+    finally:
+        server.lsp.transport = previous_transport
+    report["file"] = path
+    report["interval"] = interval
+    report["messages"] = transport.messages
+    return report
+
+
+async def _type(server, uri, initial, edits, interval, request_every, trace_memory):
+    lsp = server.lsp
+    definition = lsp.fm.features[DEFINITION]
+    completion = lsp.fm.features[COMPLETION]
+
+    lsp.lsp_text_document__did_open(
+        DidOpenTextDocumentParams(
+            text_document=TextDocumentItem(
+                uri=uri, language_id="asy", version=0, text=initial
+            )
+        )
+    )
+    await asyncio.sleep(0)  # (did_open runs as a task)
+    if trace_memory:
+        tracemalloc.start()
+    parse_count = server.parse_count
+
+    cpu = []
+    latencies = {DEFINITION: [], COMPLETION: []}
+    document = TextDocumentIdentifier(uri=uri)
+    position = Position(line=0, character=0)
+    typed = time.perf_counter()  # (when the last keystroke was sent)
+    for version, (line, character, c) in enumerate(edits, 1):
+        start = time.process_time()
+        at = Position(line=line, character=character)
+        lsp.lsp_text_document__did_change(
+            DidChangeTextDocumentParams(
+                text_document=VersionedTextDocumentIdentifier(uri=uri, version=version),
+                content_changes=[
+                    TextDocumentContentChangeEvent(
+                        range=Range(start=at, end=at), text=c
+                    )
+                ],
+            )
+        )
+        typed = time.perf_counter()
+        position = (
+            Position(line=line + 1, character=0)
+            if c == "\n"
+            else Position(line=line, character=character + 1)
+        )
+        if request_every and version % request_every == 0:
+            # go to definition of what was just typed, then complete it
+            for method, handler, params in (
+                (DEFINITION, definition, DefinitionParams),
+                (COMPLETION, completion, CompletionParams),
+            ):
+                sent = time.perf_counter()
+                handler(params(text_document=document, position=at))
+                latencies[method].append(time.perf_counter() - sent)
+        if version < len(edits):
+            # the diagnostics timers fire while waiting for the next keystroke
+            await asyncio.sleep(interval)
+        cpu.append(time.process_time() - start)
+
+    # time to fresh results after the last keystroke: the answer to a
+    # definition request sent right away, and the diagnostics of the final
+    # version
+    definition(DefinitionParams(text_document=document, position=position))
+    fresh_definition = time.perf_counter() - typed
+    deadline = typed + FRESH_RESULT_TIMEOUT_IN_SECONDS
+    while uri in server.pending_diagnostics and time.perf_counter() < deadline:
+        await asyncio.sleep(0.001)
+    fresh_diagnostics = time.perf_counter() - typed
+    file = server.parsed_files[uri][0]
+
+    report = {
+        "keystrokes": len(edits),
+        "cpu_total": sum(cpu),
+        "cpu_per_keystroke": _distribution(cpu),
+        "reparses": server.parse_count - parse_count,
+        "fresh_definition": fresh_definition,
+        "fresh_diagnostics": fresh_diagnostics,
+        "fresh": file.version == len(edits),
+        "requests": {m: _distribution(v) for m, v in latencies.items()},
+        "parsed_bytes": server.parsed_files.total_size,
+    }
+    if trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report["memory_growth"] = current
+        report["memory_peak"] = peak
+
+    lsp.lsp_text_document__did_close(DidCloseTextDocumentParams(text_document=document))
+    await asyncio.sleep(0)
+    return report
+
+
+def print_report(report, out=sys.stdout):
+    cpu = report["cpu_per_keystroke"]
+    print(
+        f"{report['file']}: {report['keystrokes']} keystrokes, "
+        f"one every {report['interval'] * 1000:.0f} ms",
+        file=out,
+    )
+    print(
+        f"CPU per keystroke   mean {cpu['mean'] * 1000:.2f} ms, "
+        f"p50 {cpu['p50'] * 1000:.2f} ms, p90 {cpu['p90'] * 1000:.2f} ms, "
+        f"p99 {cpu['p99'] * 1000:.2f} ms, max {cpu['max'] * 1000:.2f} ms, "
+        f"total {report['cpu_total']:.2f} s",
+        file=out,
+    )
+    for method, s in report["requests"].items():
+        print(
+            f"{method:<19} p50 {s['p50'] * 1000:.2f} ms, "
+            f"p90 {s['p90'] * 1000:.2f} ms, max {s['max'] * 1000:.2f} ms",
+            file=out,
+        )
+    print(f"reparses            {report['reparses']}", file=out)
+    print(
+        f"fresh result        definition {report['fresh_definition'] * 1000:.1f} ms, "
+        f"diagnostics {report['fresh_diagnostics'] * 1000:.1f} ms "
+        "after the last keystroke",
+        file=out,
+    )
+    memory = f"parsed documents {report['parsed_bytes'] / 1024:.0f} KiB"
+    if "memory_growth" in report:
+        memory += (
+            f", growth {report['memory_growth'] / 1024:.0f} KiB, "
+            f"peak {report['memory_peak'] / 1024:.0f} KiB"
+        )
+    print(f"memory              {memory}", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m server.simulator",
+        description="Types part of an .asy file back into it, in process, and "
+        "measures the cost of every keystroke.",
+    )
+    parser.add_argument("file", help=".asy file to type")
+    parser.add_argument("--line", type=int, help="line to start typing at, 1-based")
+    parser.add_argument("--keystrokes", type=int, default=KEYSTROKES)
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=KEYSTROKE_INTERVAL_IN_SECONDS,
+        help="seconds between keystrokes",
+    )
+    parser.add_argument(
+        "--request-every",
+        type=int,
+        default=REQUEST_EVERY,
+        help="keystrokes between definition and completion requests, 0 for none",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="measure memory growth with tracemalloc, slowing everything down",
+    )
+    parser.add_argument("--output", help="write the report as JSON")
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        help="fail if the p90 CPU time per keystroke is over this",
+    )
+    args = parser.parse_args(argv)
+
+    report = simulate(
+        args.file,
+        args.line - 1 if args.line else None,
+        args.keystrokes,
+        args.interval,
+        args.request_every,
+        trace_memory=args.trace_memory,
+    )
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.budget_ms is not None:
+        p90 = report["cpu_per_keystroke"]["p90"] * 1000
+        if p90 > args.budget_ms:
+            print(
+                f"OVER BUDGET: p90 CPU per keystroke {p90:.2f} ms > "
+                f"{args.budget_ms:.2f} ms",
+                file=sys.stderr,
+            )
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
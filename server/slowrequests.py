@@ -0,0 +1,214 @@
+import contextvars
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+
+SLOW_REQUEST_BUNDLES = 20
+STACK_SAMPLE_INTERVAL_IN_SECONDS = 0.05
+STACK_SAMPLES = 20
+STACK_DEPTH = 30
+# names of the bundle directories, the only ones rotated
+BUNDLE_NAME = re.compile(r"\d{8}-\d{6}-\d{3}-[A-Za-z0-9-]*")
+
+# the request of the handler running in this context: the stages of a parse
+# go to the request that asked for it, whatever the thread
+_current = contextvars.ContextVar("slow_request", default=None)
+
+
+class _Request(object):
+    __slots__ = (
+        "method",
+        "params",
+        "thread_id",
+        "start",
+        "stages",
+        "stacks",
+        "coroutine",
+        "token",
+    )
+
+    def __init__(self, method, params, start):
+        self.method = method
+        self.params = params
+        self.thread_id = threading.get_ident()
+        self.start = start
+        self.stages = []  # [(parse_file stage, seconds)] while running
+        self.stacks = []  # [(seconds since start, stack lines)]
+        self.coroutine = None  # (of an async handler, sampled while suspended)
+        self.token = None  # (to reset _current when the request ends)
+
+
+def _jsonable(obj):
+    # params are pydantic models, or namedtuples for the methods pygls does
+    # not know
+    if hasattr(obj, "_asdict"):
+        return {key: _jsonable(value) for key, value in obj._asdict().items()}
+    if hasattr(obj, "dict") and callable(obj.dict):
+        return json.loads(obj.json(by_alias=True, exclude_unset=True))
+    if isinstance(obj, (list, tuple)):
+        return [_jsonable(value) for value in obj]
+    if isinstance(obj, dict):
+        return {key: _jsonable(value) for key, value in obj.items()}
+    return obj
+
+
+def _document_uri(params):
+    for name in ("text_document", "textDocument"):
+        document = getattr(params, name, None)
+        if document is not None:
+            return getattr(document, "uri", None)
+    return None
+
+
+def _frame_line(frame):
+    code = frame.f_code
+    line = frame.f_lineno or code.co_firstlineno  # (None between lines)
+    return f"{code.co_filename}:{line} {code.co_name}"
+
+
+def _stack(frame):
+    lines = []
+    while frame is not None and len(lines) < STACK_DEPTH:
+        lines.append(_frame_line(frame))
+        frame = frame.f_back
+    return lines
+
+
+def _coroutine_stack(coroutine):
+    # innermost first, like _stack: the chain of awaits of a suspended
+    # coroutine
+    frames = []
+    while coroutine is not None and len(frames) < STACK_DEPTH:
+        frame = getattr(coroutine, "cr_frame", None) or getattr(
+            coroutine, "gi_frame", None
+        )
+        if frame is None:
+            break
+        frames.append(frame)
+        coroutine = getattr(coroutine, "cr_await", None) or getattr(
+            coroutine, "gi_yieldfrom", None
+        )
+    return [_frame_line(frame) for frame in reversed(frames)]
+
+
+class SlowRequests(object):
+    r"""
+    Saves a repro bundle for every handler of `server` taking more than
+    `threshold` seconds: a directory in `directory` with the document as
+    document.asy, and the params, version, configuration, timings and stack
+    samples as request.json. Only the newest `keep` bundles are kept; other
+    entries of `directory` are never touched.
+    """
+
+    def __init__(self, server, directory, threshold, keep=SLOW_REQUEST_BUNDLES):
+        self.server = server
+        self.directory = directory
+        self.threshold = threshold
+        self.keep = keep
+        self.running = {}  # (id of a _Request: _Request)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._sample, name="slow-requests", daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+
+    def begin(self, method, params, start):
+        r"""
+        Starts recording a request, in the context of its handler: begin and
+        end must be called from the same context.
+        """
+        request = _Request(method, params, start)
+        request.token = _current.set(request)
+        self.running[id(request)] = request
+        return request
+
+    def stage(self, stage, seconds):
+        request = _current.get()
+        if request is not None and id(request) in self.running:
+            request.stages.append((stage, seconds))
+
+    def _sample(self):
+        # samples the stacks of the requests running for half the threshold
+        while not self._stop.wait(STACK_SAMPLE_INTERVAL_IN_SECONDS):
+            now = time.perf_counter()
+            frames = None
+            for request in list(self.running.values()):
+                elapsed = now - request.start
+                if elapsed < self.threshold / 2 or len(request.stacks) >= STACK_SAMPLES:
+                    continue
+                coroutine = request.coroutine
+                if coroutine is not None and not coroutine.cr_running:
+                    # suspended: the loop thread runs something else
+                    stack = _coroutine_stack(coroutine)
+                    if stack:
+                        request.stacks.append((elapsed, stack))
+                    continue
+                if frames is None:
+                    frames = sys._current_frames()
+                frame = frames.get(request.thread_id)
+                if frame is not None:
+                    request.stacks.append((elapsed, _stack(frame)))
+
+    def end(self, request, received, end, error):
+        self.running.pop(id(request), None)
+        try:
+            _current.reset(request.token)
+        except ValueError:
+            pass  # (ended from another context)
+        if end - request.start < self.threshold:
+            return
+        try:
+            self._save(request, received, end, error)
+        except (OSError, TypeError, ValueError):
+            pass  # (a failed capture must not fail the request)
+
+    def _save(self, request, received, end, error):
+        uri = _document_uri(request.params)
+        document = None
+        if uri is not None and self.server.workspace is not None:
+            document = self.server.workspace.get_document(uri)
+
+        now = time.time()
+        name = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+        name += f"-{int(now * 1000) % 1000:03d}-"
+        name += re.sub(r"[^A-Za-z0-9]+", "-", request.method or "unknown")
+        path = os.path.join(self.directory, name)
+        os.makedirs(path, exist_ok=True)
+        bundle = {
+            "method": request.method,
+            "params": _jsonable(request.params),
+            "error": error,
+            "uri": uri,
+            "version": document.version if document is not None else None,
+            "configuration": self.server.configuration,
+            "timing": {
+                "queue_wait": request.start - received,
+                "handler": end - request.start,
+                "total": end - received,
+                "stages": request.stages,
+            },
+            "stacks": request.stacks,
+        }
+        if document is not None:
+            with open(os.path.join(path, "document.asy"), "w") as f:
+                f.write(document.source)
+        with open(os.path.join(path, "request.json"), "w") as f:
+            json.dump(bundle, f, indent=2, default=str)
+        self._rotate()
+
+    def _rotate(self):
+        bundles = sorted(
+            name
+            for name in os.listdir(self.directory)
+            if BUNDLE_NAME.fullmatch(name)
+            and os.path.isfile(os.path.join(self.directory, name, "request.json"))
+        )
+        for name in bundles[: max(len(bundles) - self.keep, 0)]:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
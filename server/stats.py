@@ -0,0 +1,252 @@
+import asyncio
+import bisect
+import functools
+import os
+import time
+
+from pygls.feature_manager import assign_thread_attr, is_thread_function
+
+# upper bounds of the histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS_IN_SECONDS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+STATS_DUMP_INTERVAL_IN_SECONDS = 60
+
+
+class Histogram(object):
+    r"""
+    Counts of observed durations in LATENCY_BUCKETS_IN_SECONDS, with their sum
+    and maximum.
+    """
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_IN_SECONDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_IN_SECONDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        r"""
+        Upper bound of the bucket holding the `p`th percentile, the maximum
+        for the unbounded bucket.
+        """
+        rank = self.count * p / 100
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_IN_SECONDS, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+            "buckets": list(self.counts),
+        }
+
+
+class MethodStats(object):
+    __slots__ = ("latency", "queue_wait", "errors")
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.queue_wait = Histogram()
+        self.errors = 0
+
+
+class ServerStats(object):
+    r"""
+    Latency histograms, error counts and queue wait of every LSP method, and
+    latency histograms of the stages of parse_file.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.methods = {}  # (method: MethodStats)
+        self.stages = {}  # (stage: Histogram)
+        self.tracer = None  # (tracing.Tracer also getting the handler spans)
+        self.slow_requests = None  # (slowrequests.SlowRequests, if enabled)
+
+    def _method(self, method):
+        stats = self.methods.get(method)
+        if stats is None:
+            stats = self.methods[method] = MethodStats()
+        return stats
+
+    def observe(self, method, seconds, queue_wait=0.0, error=False):
+        stats = self._method(method)
+        stats.latency.observe(seconds)
+        stats.queue_wait.observe(queue_wait)
+        if error:
+            stats.errors += 1
+
+    def observe_stage(self, stage, seconds):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.observe(seconds)
+        if self.slow_requests is not None:
+            self.slow_requests.stage(stage, seconds)
+
+    def _begin(self, method, args):
+        # (time the handler starts, its slowrequests record or None)
+        start = time.perf_counter()
+        slow_requests = self.slow_requests
+        if slow_requests is None:
+            return start, None
+        return start, (
+            slow_requests,
+            slow_requests.begin(method, args[0] if args else None, start),
+        )
+
+    def _finish(self, method, received, start, error, slow=None):
+        end = time.perf_counter()
+        self.observe(method, end - start, start - received, error)
+        if slow is not None:
+            slow_requests, request = slow
+            slow_requests.end(request, received, end, error)
+        tracer = self.tracer
+        if tracer is not None:
+            tracer.complete("queue", received, start, "schedule", {"method": method})
+            tracer.complete(method, start, end, "handler", {"error": error})
+
+    def timed(self, method, handler, received):
+        r"""
+        Returns `handler` recording its latency under `method`, and the time
+        it waited since the message was received at `received`, keeping what
+        pygls looks at to run it: coroutine, thread or plain function.
+        """
+        begin, finish = self._begin, self._finish
+
+        if asyncio.iscoroutinefunction(handler):
+
+            @functools.wraps(handler)
+            async def wrapper(*args, **kwargs):
+                start, slow = begin(method, args)
+                error = True
+                try:
+                    coroutine = handler(*args, **kwargs)
+                    if slow is not None:
+                        slow[1].coroutine = coroutine
+                    result = await coroutine
+                    error = False
+                    return result
+                finally:
+                    finish(method, received, start, error, slow)
+
+            return wrapper
+
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            start, slow = begin(method, args)
+            error = True
+            try:
+                result = handler(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                finish(method, received, start, error, slow)
+
+        if is_thread_function(handler):
+            assign_thread_attr(wrapper)
+        return wrapper
+
+    def to_dict(self):
+        return {
+            "uptime": time.time() - self.started,
+            "buckets": list(LATENCY_BUCKETS_IN_SECONDS),
+            "methods": {
+                method: {
+                    "latency": stats.latency.to_dict(),
+                    "queue_wait": stats.queue_wait.to_dict(),
+                    "errors": stats.errors,
+                }
+                for method, stats in sorted(self.methods.items())
+            },
+            "stages": {
+                stage: histogram.to_dict()
+                for stage, histogram in sorted(self.stages.items())
+            },
+        }
+
+    def prometheus(self):
+        r"""
+        The statistics in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def histogram(name, label, value, h):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS_IN_SECONDS, h.counts):
+                cumulative += count
+                lines.append(
+                    f'{name}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'{name}_bucket{{{label}="{value}",le="+Inf"}} {h.count}')
+            lines.append(f'{name}_sum{{{label}="{value}"}} {h.sum}')
+            lines.append(f'{name}_count{{{label}="{value}"}} {h.count}')
+
+        methods = sorted(self.methods.items())
+        for name, help, attribute in (
+            ("asy_lsp_request_seconds", "Handler latency.", "latency"),
+            (
+                "asy_lsp_queue_wait_seconds",
+                "Time before the handler ran.",
+                "queue_wait",
+            ),
+        ):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} histogram")
+            for method, stats in methods:
+                histogram(name, "method", method, getattr(stats, attribute))
+
+        lines.append("# HELP asy_lsp_request_errors_total Handlers that raised.")
+        lines.append("# TYPE asy_lsp_request_errors_total counter")
+        for method, stats in methods:
+            lines.append(
+                f'asy_lsp_request_errors_total{{method="{method}"}} {stats.errors}'
+            )
+
+        lines.append("# HELP asy_lsp_parse_stage_seconds Latency of parse stages.")
+        lines.append("# TYPE asy_lsp_parse_stage_seconds histogram")
+        for stage, h in sorted(self.stages.items()):
+            histogram("asy_lsp_parse_stage_seconds", "stage", stage, h)
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        r"""
+        Writes the Prometheus text to `path` atomically, for a textfile
+        collector.
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
@@ -0,0 +1,92 @@
+import pytest
+
+from server import asyformatter
+from server.parser import workload
+
+MESSY = """import graph;
+   struct A{
+int x;   // trailing
+real f(real t){return -t*2+x;}
+}
+/* block
+   comment */
+path p=(0,0)--(1,1)..controls (2,2) and (3,3)..(4,4)^^(5,5)::cycle;
+for(int i=0;i<10;++i)
+draw(p,
+red);
+int[] a={1,2,
+3};
+if (a[0]>1) x=- -1; else
+{
+  y = x-1;
+}
+while (--i>0) { write(i); }
+pair z = dir(-30)*2^2;   
+@ junk;
+"""
+
+SOURCES = {
+    "messy": MESSY,
+    "nesting": workload.deep_nesting(10),
+    "long_lines": workload.long_lines(5),
+    "arrays": workload.array_initializers(5),
+}
+
+
+def _tokens(code):
+    return [(type, text) for _, type, text in asyformatter._items(code) if text]
+
+
+@pytest.mark.parametrize("name", sorted(SOURCES))
+def test_format_is_idempotent(name):
+    formatted = asyformatter.format_text(SOURCES[name])
+    assert asyformatter.format_text(formatted) == formatted
+
+
+@pytest.mark.parametrize("name", sorted(SOURCES))
+def test_format_keeps_tokens(name):
+    code = SOURCES[name]
+    assert _tokens(asyformatter.format_text(code)) == _tokens(code)
+
+
+def test_format_ranges_only_touch_their_lines():
+    formatted = asyformatter.format_text(MESSY, [(2, 3)])
+    lines, original = formatted.splitlines(), MESSY.splitlines()
+    assert lines[2:4] == [
+        "  int x;   // trailing",
+        "  real f(real t) { return -t * 2 + x; }",
+    ]
+    assert lines[:2] == original[:2]
+    assert lines[4:] == original[4:]
+
+
+@pytest.mark.parametrize(
+    "code, formatted",
+    [
+        ("--i;\n", "--i;\n"),
+        ("x = -- i;\n", "x = --i;\n"),
+        ("x = ++ i;\n", "x = ++i;\n"),
+        ("for (int i = 0; i < n; ++ i) {\n}\n", "for (int i = 0; i < n; ++i) {\n}\n"),
+        ("x = - --i;\n", "x = - --i;\n"),
+        ("draw(a--b);\n", "draw(a -- b);\n"),
+        ("draw(a-- --b);\n", "draw(a -- --b);\n"),
+    ],
+)
+def test_prefix_operators(code, formatted):
+    assert asyformatter.format_text(code) == formatted
+
+
+@pytest.mark.parametrize(
+    "code, formatted",
+    [
+        ("real[] a = {\n1,\n2,\n3\n};\n", "real[] a = {\n  1,\n  2,\n  3\n};\n"),
+        (
+            "void f() {\nreal[][] m = {\n{1, 2},\n{3,\n4}\n};\n}\n",
+            "void f() {\n  real[][] m = {\n    {1, 2},\n    {3,\n      4}\n  };\n}\n",
+        ),
+        ("int[] a={1,2,\n3};\n", "int[] a = {1, 2,\n  3};\n"),
+    ],
+)
+def test_array_initializer_elements_share_a_level(code, formatted):
+    assert asyformatter.format_text(code) == formatted
+    assert asyformatter.format_text(formatted) == formatted
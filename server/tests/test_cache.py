@@ -0,0 +1,116 @@
+import os
+
+import pytest
+
+from server import cache
+from server.cache import DocumentCache, source_hash
+from server.parser.ast import FileParsed
+
+SOURCE = "real f(real x) { return x * 2; }\nreal y = f(1);\n"
+
+
+def _parse(source=SOURCE):
+    file = FileParsed("cache.asy")
+    file.parse(source)
+    file.construct_jump_table()
+    file.release_parser()
+    file.source_hash = source_hash(source)
+    return file
+
+
+@pytest.fixture(scope="module")
+def file():
+    return _parse()
+
+
+@pytest.fixture
+def spill_dir(tmp_path):
+    path = tmp_path / "spill"
+    path.mkdir(mode=0o700)
+    return str(path)
+
+
+def test_estimated_size_counts_cached_results(file):
+    size = cache.estimated_size(file)
+    assert size == len(file.all_tokens) * cache.PARSED_BYTES_PER_TOKEN
+    documents = DocumentCache()
+    documents["a"] = (file, 0.0)
+    file.cache["symbols"] = []
+    try:
+        documents.measure()
+        assert documents.total_size == documents.sizes["a"] > size
+    finally:
+        file.cache.clear()
+
+
+def test_evicts_closed_then_least_recently_used(file):
+    size = cache.estimated_size(file)
+    documents = DocumentCache(budget=3 * size)
+    for uri in "abc":
+        documents.open(uri)
+        documents[uri] = (file, 0.0)
+    documents.close("b")
+    assert documents.keys() == ["a", "c"]
+
+    documents["d"] = (file, 0.0)
+    documents.open("d")
+    documents["a"]  # (most recently used)
+    documents["e"] = (file, 0.0)
+    assert documents.keys() == ["d", "a", "e"]
+    # e is not open: evicted before the least recently used d
+    documents["f"] = (file, 0.0)
+    assert documents.keys() == ["d", "a", "f"]
+    assert documents.evictions == 2
+    assert documents.total_size == 3 * size
+
+
+def test_spill_and_restore(file, spill_dir):
+    documents = DocumentCache(budget=0, spill_dir=spill_dir)
+    documents["a"] = (file, 1.0)
+    documents["b"] = (file, 2.0)
+    assert documents.keys() == ["b"]
+    assert len(os.listdir(spill_dir)) == 1
+
+    assert documents.restore("a", SOURCE + "\n") is None
+    restored, parsed = documents.restore("a", SOURCE)
+    assert parsed == 1.0
+    assert (
+        restored.find_exported("f")["position"] == file.find_exported("f")["position"]
+    )
+    # (restored once, then removed)
+    assert documents.restore("a", SOURCE) is None
+    assert os.listdir(spill_dir) == []
+
+
+def test_restore_rejects_files_it_did_not_sign(file, spill_dir):
+    documents = DocumentCache(budget=0, spill_dir=spill_dir)
+    documents["a"] = (file, 1.0)
+    documents.close("a")
+    (path,) = [os.path.join(spill_dir, name) for name in os.listdir(spill_dir)]
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+    data[-1] ^= 1
+    with open(path, "wb") as f:
+        f.write(data)
+    assert documents.restore("a", SOURCE) is None
+
+    # another cache has another key
+    documents.close("a")
+    documents["a"] = (file, 1.0)
+    documents.close("a")
+    assert DocumentCache(spill_dir=spill_dir).restore("a", SOURCE) is None
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="POSIX permissions")
+def test_no_spill_to_shared_directories(file, spill_dir):
+    os.chmod(spill_dir, 0o755)
+    documents = DocumentCache(budget=0, spill_dir=spill_dir)
+    documents["a"] = (file, 1.0)
+    documents.close("a")
+    assert os.listdir(spill_dir) == []
+
+    os.chmod(spill_dir, 0o700)
+    documents["a"] = (file, 1.0)
+    documents.close("a")
+    os.chmod(spill_dir, 0o755)
+    assert documents.restore("a", SOURCE) is None
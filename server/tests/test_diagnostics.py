@@ -0,0 +1,52 @@
+import pytest
+from pygls.lsp import LSP_METHODS_MAP
+from pygls.lsp.methods import INITIALIZE
+from pygls.uris import from_fs_path
+from pygls.workspace import Workspace
+
+from server.server import asy_lsp_server
+
+MODULES = {"a": "import b;\nint x = 1;\n", "b": "import c;\n", "c": "int y = 2;\n"}
+
+
+@pytest.fixture
+def uris(tmp_path):
+    uris = {}
+    for name, text in MODULES.items():
+        path = tmp_path / (name + ".asy")
+        path.write_text(text)
+        uris[name] = from_fs_path(str(path))
+    asy_lsp_server.lsp.workspace = Workspace(from_fs_path(str(tmp_path)), None)
+    yield uris
+    for uri in uris.values():
+        if uri in asy_lsp_server.parsed_files:
+            del asy_lsp_server.parsed_files[uri]
+
+
+def test_result_id_follows_transitive_imports(uris):
+    report = asy_lsp_server.diagnostics_report(uris["a"])
+    assert report["kind"] == "full"
+    result_id = report["resultId"]
+    assert asy_lsp_server.diagnostics_report(uris["a"], result_id)["kind"] == (
+        "unchanged"
+    )
+
+    asy_lsp_server.parse_file(uris["c"])
+    report = asy_lsp_server.diagnostics_report(uris["a"], result_id)
+    assert report["kind"] == "full"
+    assert report["resultId"] != result_id
+
+
+@pytest.mark.parametrize(
+    "text_document, pulls",
+    [({}, False), ({"diagnostic": {"dynamicRegistration": False}}, True)],
+)
+def test_pulls_diagnostics(monkeypatch, text_document, pulls):
+    params_type = LSP_METHODS_MAP[INITIALIZE][1]
+    params = params_type.parse_obj(
+        {"processId": None, "capabilities": {"textDocument": text_document}}
+    )
+    monkeypatch.setattr(
+        asy_lsp_server.lsp, "client_capabilities", params.capabilities, raising=False
+    )
+    assert asy_lsp_server.pulls_diagnostics is pulls
@@ -0,0 +1,168 @@
+import asyncio
+import random
+from collections import OrderedDict
+
+import pytest
+
+from server import formatter
+from server.parser.ast import FileParsed
+
+
+def _apply(text, edits):
+    # edits are (start_line, start_character, end_line, end_character, text)
+    lines = text.splitlines(keepends=True)
+    starts = [0]
+    for line in lines:
+        starts.append(starts[-1] + len(line))
+
+    def offset(line, character):
+        return starts[line] + character if line < len(lines) else len(text)
+
+    for sl, sc, el, ec, new_text in sorted(edits, reverse=True):
+        text = text[: offset(sl, sc)] + new_text + text[offset(el, ec) :]
+    return text
+
+
+@pytest.mark.parametrize(
+    "original, formatted",
+    [
+        ("int x=1;\n", "int x = 1;\n"),
+        ("a;\nb;\n", "a;\nb;\n"),
+        ("a;\n\n\n\nb;\n", "a;\n\nb;\n"),
+        ("if (x) {\ny;\n}\n", "if (x) {\n  y;\n}\n"),
+        ("a;\r\nb;\r\n", "a;\nb;\n"),
+        ("a;", "a;\n"),
+        ("a;\n", ""),
+        ("", "a;\n"),
+    ],
+)
+def test_diff_edits(original, formatted):
+    assert _apply(original, formatter.diff_edits(original, formatted)) == formatted
+
+
+def test_diff_edits_are_minimal():
+    edits = formatter.diff_edits("int x=1;\nint y = 2;\n", "int x = 1;\nint y = 2;\n")
+    assert edits == [(0, 5, 0, 6, " = ")]
+
+
+def test_diff_edits_random():
+    rng = random.Random(0)
+    words = ["a", " ", "  ", "\n", ";", "{", "}", "\r\n"]
+    for _ in range(300):
+        original = "".join(rng.choice(words) for _ in range(rng.randrange(30)))
+        formatted = "".join(rng.choice(words) for _ in range(rng.randrange(30)))
+        edits = formatter.diff_edits(original, formatted)
+        assert _apply(original, edits) == formatted, (original, formatted)
+
+
+ON_TYPE_SOURCE = """import graph;
+real f(real x){
+real y=x*2;
+  if (y>1) {
+y=-y;}
+return y+x;
+}
+for(int i=0;i<3;++i)
+draw((0,0)--(i,i));
+struct Point{real x;
+real y;}
+int[] a={1,2,
+3};
+"""
+
+
+def _starts(source):
+    file = FileParsed("on_type.asy")
+    file.parse(source)
+    return formatter.statement_starts(file.all_tokens)
+
+
+def _first_edited(parsed, code):
+    # what did_change records: the first line changed since the parse
+    for line, (a, b) in enumerate(zip(parsed.splitlines(), code.splitlines())):
+        if a != b:
+            return line
+    return min(len(parsed.splitlines()), len(code.splitlines()))
+
+
+def test_on_type_edits_from_statement_start():
+    code = ON_TYPE_SOURCE * 3
+    starts = _starts(code)
+    assert starts
+    checked = 0
+    for line, text in enumerate(code.splitlines()):
+        if text.rstrip().endswith((";", "}")):
+            expected = formatter.format_on_type_edits(code, line)
+            assert formatter.format_on_type_edits(code, line, starts) == expected
+            checked += bool(expected)
+    assert checked
+
+
+@pytest.mark.parametrize(
+    "parsed, code, line",
+    [
+        ("a = 1;\nb = 2;\nc = 3;\n", "a = 1;\nif (t) {\nb = 2;\nc = 3;\n", 3),
+        ("x = 1;\nx = 1;\n", "void f() {\nx = 1;\nx = 1;\n}\n", 2),
+        ("a;\nb;\nc;\nd;\n", "a;\nif (t) {\nb;\nc;\nd;\n", 4),
+        (
+            ON_TYPE_SOURCE * 3,
+            ON_TYPE_SOURCE + "void g() {\n" + ON_TYPE_SOURCE * 2,
+            None,
+        ),
+        (
+            ON_TYPE_SOURCE * 3,
+            ON_TYPE_SOURCE + "int q;\n" + ON_TYPE_SOURCE * 2,
+            None,
+        ),
+    ],
+)
+def test_on_type_edits_with_stale_parse(parsed, code, line):
+    starts = _starts(parsed)
+    edited = _first_edited(parsed, code)
+    if line is None:
+        lines = [
+            i
+            for i, text in enumerate(code.splitlines())
+            if text.rstrip().endswith((";", "}"))
+        ]
+    else:
+        lines = [line]
+    for line in lines:
+        expected = formatter.format_on_type_edits(code, line)
+        assert (
+            formatter.format_on_type_edits(code, line, starts, edited) == expected
+        ), line
+    if len(lines) == 1:
+        assert expected
+
+
+def test_run_clang_format_without_the_program(monkeypatch, tmp_path):
+    missing = ["asy-lsp-no-such-clang-format"]
+    assert formatter.run_clang_format(missing, "a;\n") is None
+
+    monkeypatch.setattr(formatter, "CLANG_FORMAT_CMD", missing)
+    path = tmp_path / "a.asy"
+    path.write_text("int x=1;\n")
+    task = (str(path), formatter.CLANG_FORMAT, None, False, False)
+    assert formatter._format_file(task) == (str(path), "error", None, "")
+
+
+def test_run_clang_format_timeout(monkeypatch):
+    monkeypatch.setattr(formatter, "CLANG_FORMAT_TIMEOUT_IN_SECONDS", 0.1)
+    assert formatter.run_clang_format(["sleep", "5"]) is None
+
+
+def test_ranges_edits_share_the_cache_across_paths(monkeypatch):
+    monkeypatch.setattr(formatter, "_format_cache", OrderedDict())
+    monkeypatch.setattr(formatter, "_formatted_hashes", OrderedDict())
+    monkeypatch.setattr(formatter, "run_clang_format", lambda args, code: "a = 1;\n")
+    code = "a=1;\n"
+    edits = formatter.format_ranges_edits(code, [(0, 0)])
+    assert _apply(code, edits) == "a = 1;\n"
+
+    async def not_cached(args, code):
+        raise AssertionError("the cached edits were not found")
+
+    monkeypatch.setattr(formatter, "run_clang_format_async", not_cached)
+    coroutine = formatter.format_ranges_edits_async(code, [(0, 0)])
+    assert asyncio.run(coroutine) == edits
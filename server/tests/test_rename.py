@@ -0,0 +1,68 @@
+import pytest
+from pygls.exceptions import JsonRpcInvalidParams
+from pygls.lsp.types import (
+    Position,
+    RenameParams,
+    TextDocumentIdentifier,
+    TextDocumentItem,
+)
+from pygls.uris import from_fs_path
+from pygls.workspace import Workspace
+
+from server.server import asy_lsp_server, rename
+
+SOURCE = """real f(real x) {
+  real y = x * 2;
+  return y + x;
+}
+real x = f(1);
+write(x);
+"""
+
+
+@pytest.fixture
+def uri(tmp_path):
+    path = tmp_path / "rename.asy"
+    path.write_text(SOURCE)
+    uri = from_fs_path(str(path))
+    workspace = Workspace(from_fs_path(str(tmp_path)), None)
+    workspace.put_document(
+        TextDocumentItem(uri=uri, language_id="asy", version=1, text=SOURCE)
+    )
+    asy_lsp_server.lsp.workspace = workspace
+    yield uri
+    if uri in asy_lsp_server.parsed_files:
+        del asy_lsp_server.parsed_files[uri]
+
+
+def _rename(uri, line, character, new_name):
+    return rename(
+        RenameParams(
+            text_document=TextDocumentIdentifier(uri=uri),
+            position=Position(line=line, character=character),
+            new_name=new_name,
+        )
+    )
+
+
+@pytest.mark.parametrize("new_name", ["", "1x", "a-b", "x y", "for", "return"])
+def test_rename_rejects_invalid_identifiers(uri, new_name):
+    with pytest.raises(JsonRpcInvalidParams):
+        _rename(uri, 4, 5, new_name)
+
+
+def test_rename_global(uri):
+    edit = _rename(uri, 4, 5, "_x2")
+    spans = [
+        (e.range.start.line, e.range.start.character, e.range.end.character)
+        for e in edit.changes[uri]
+    ]
+    # the parameter x of f is another symbol
+    assert spans == [(4, 5, 6), (5, 6, 7)]
+    assert all(e.new_text == "_x2" for e in edit.changes[uri])
+
+
+def test_rename_parameter(uri):
+    edit = _rename(uri, 1, 11, "t")
+    spans = [(e.range.start.line, e.range.start.character) for e in edit.changes[uri]]
+    assert spans == [(0, 12), (1, 11), (2, 13)]
@@ -0,0 +1,83 @@
+import pytest
+
+from server.parser import workload
+from server.parser.ast import FileParsed
+
+SOURCES = {
+    "blocks": """real f(real x) {
+  real y = x * 2;
+  {
+    real a = 5; { int b = 1; } write(a);
+  }
+  return y + x;
+}
+
+for (int i = 0; i < 3; ++i) {
+  real a = f(i);
+}
+struct Point { real x; real y; }
+""",
+    "unclosed": """void g() {
+  int x = 1;
+  if (x > 0) {
+    x = 2;
+""",
+    "nesting": workload.deep_nesting(8),
+}
+
+
+def _brute_force(scopes, line, column):
+    # the deepest scope whose braces surround (line, column)
+    found = scopes.global_scope
+    for scope in scopes.all_scopes():
+        if scope.start > (line, column):
+            continue
+        if scope.end[0] >= 0 and scope.end < (line, column):
+            continue
+        if scope.depth > found.depth:
+            found = scope
+    return found
+
+
+@pytest.mark.parametrize("name", sorted(SOURCES))
+def test_find_matches_brute_force(name):
+    source = SOURCES[name]
+    file = FileParsed(name + ".asy")
+    file.parse(source)
+    file.construct_jump_table()
+    assert len(list(file.scopes.all_scopes())) > 1
+    for line, text in enumerate(source.splitlines(), 1):
+        for column in range(1, len(text) + 2):
+            expected = _brute_force(file.scopes, line, column)
+            assert file.find_scope(line, column) is expected, (line, column)
+
+
+VISIBLE = """struct P { real x; }
+real g = 1;
+real f(real a) {
+  real g = a;
+  return g;
+}
+"""
+
+
+@pytest.mark.parametrize(
+    "line, column, expected",
+    [
+        (2, 1, [("P", "RECORD"), ("g", "VAR"), ("f", "FUNCTION")]),
+        (
+            5,
+            3,
+            [("a", "PARAMETER"), ("g", "VAR"), ("P", "RECORD"), ("f", "FUNCTION")],
+        ),
+    ],
+)
+def test_visible_declarations(line, column, expected):
+    file = FileParsed("visible.asy")
+    file.parse(VISIBLE)
+    file.construct_jump_table()
+    items = file.visible_declarations(line, column)
+    assert [(item["value"], item["type"]) for item in items] == expected
+    if line == 5:
+        # the local g shadows the global one
+        assert items[1]["position"] == (4, 8)
@@ -0,0 +1,80 @@
+import random
+from array import array
+
+import pytest
+
+from server import semantictokens
+from server.parser.ast import FileParsed
+
+SOURCE = """import graph;
+real f(real x) { real y = x * 2; return y + x; }
+struct Point { real x; real y; }
+Point p; real z = f(p.x) + f(p.y);
+"""
+
+
+def _naive(tokens):
+    # the relative encoding of the LSP specification, one token at a time
+    data = []
+    line = column = 0
+    for t_line, t_column, length, type in tokens:
+        t_line, t_column = t_line - 1, t_column - 1
+        delta_column = t_column - column if t_line == line else t_column
+        type_index, modifiers = semantictokens._encoding[type]
+        data += [t_line - line, delta_column, length, type_index, modifiers]
+        line, column = t_line, t_column
+    return data
+
+
+@pytest.fixture(scope="module")
+def tokens():
+    file = FileParsed("semantic.asy")
+    file.parse(SOURCE)
+    file.construct_jump_table()
+    return file.semantic_tokens
+
+
+def test_encode(tokens):
+    assert len(tokens) > 10
+    arrays = semantictokens.TokenArrays(tokens)
+    assert list(arrays.encode()) == _naive(tokens)
+    assert list(arrays.encode(3, 7)) == _naive(tokens[3:7])
+    assert list(semantictokens.TokenArrays([]).encode()) == []
+
+
+def test_encode_range(tokens):
+    arrays = semantictokens.TokenArrays(tokens)
+    start, end = (1, 17), (3, 9)
+    inside = [t for t in tokens if start <= (t[0] - 1, t[1] - 1) < end]
+    assert inside
+    assert list(arrays.encode_range(start, end)) == _naive(inside)
+
+
+def _apply(old, edit):
+    start, delete_count, data = edit
+    return old[:start] + data + old[start + delete_count :]
+
+
+def test_diff():
+    rng = random.Random(0)
+    for _ in range(200):
+        old = array("I", (rng.randrange(4) for _ in range(rng.randrange(40))))
+        new = array("I", old)
+        for _ in range(rng.randrange(1, 4)):
+            i = rng.randrange(len(new) + 1)
+            new[i : i + rng.randrange(3)] = array(
+                "I", (rng.randrange(4) for _ in range(rng.randrange(3)))
+            )
+        edit = semantictokens.diff(old, new)
+        if old == new:
+            assert edit is None
+        else:
+            assert _apply(old, edit) == new
+
+
+def test_diff_block_boundaries():
+    old = array("I", range(3000))
+    new = array("I", old)
+    new[1500] = 7
+    assert semantictokens.diff(old, new) == (1500, 1, array("I", [7]))
+    assert semantictokens.diff(old, array("I", old)) is None
@@ -0,0 +1,52 @@
+import asyncio
+import os
+import time
+import types
+
+from server.slowrequests import SlowRequests
+
+
+def _slow_requests(directory, keep=2):
+    server = types.SimpleNamespace(workspace=None, configuration={})
+    return SlowRequests(server, str(directory), threshold=0, keep=keep)
+
+
+def test_rotation_keeps_other_directories(tmp_path):
+    (tmp_path / "project").mkdir()
+    (tmp_path / "project" / "main.asy").write_text("x;\n")
+    (tmp_path / "20000101-000000-000-notes").mkdir()
+    slow_requests = _slow_requests(tmp_path)
+    try:
+        for _ in range(4):
+            request = slow_requests.begin("textDocument/definition", None, 0.0)
+            slow_requests.end(request, 0.0, time.perf_counter(), False)
+            time.sleep(0.002)  # (bundle names have milliseconds)
+    finally:
+        slow_requests.close()
+    names = sorted(os.listdir(tmp_path))
+    bundles = [name for name in names if name.endswith("-textDocument-definition")]
+    assert len(bundles) == 2
+    assert "project" in names and "20000101-000000-000-notes" in names
+    assert os.path.isfile(tmp_path / "project" / "main.asy")
+
+
+def test_stages_go_to_their_request(tmp_path):
+    slow_requests = _slow_requests(tmp_path)
+
+    async def handler(name, delay):
+        request = slow_requests.begin(name, None, time.perf_counter())
+        await asyncio.sleep(delay)
+        slow_requests.stage(name, delay)
+        stages = list(request.stages)
+        slow_requests.end(request, 0.0, time.perf_counter(), False)
+        return stages
+
+    async def main():
+        return await asyncio.gather(handler("a", 0.02), handler("b", 0.01))
+
+    try:
+        # both handlers run on the same thread
+        assert asyncio.run(main()) == [[("a", 0.02)], [("b", 0.01)]]
+        slow_requests.stage("parse", 1.0)  # (outside any request)
+    finally:
+        slow_requests.close()
@@ -0,0 +1,105 @@
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+TRACE_FLUSH_INTERVAL_IN_SECONDS = 1.0
+
+
+class Tracer(object):
+    r"""
+    Records spans in memory and appends them to `path` from a background
+    thread, in the Chrome trace event format read by Perfetto and
+    chrome://tracing. Times are time.perf_counter() seconds.
+    """
+
+    def __init__(self, path, flush_interval=TRACE_FLUSH_INTERVAL_IN_SECONDS):
+        self.path = path
+        self.pid = os.getpid()
+        self.events = collections.deque()  # (appended and popped thread safely)
+        self.threads = set()  # (native ids of the threads named in the trace)
+        with open(path, "w") as f:
+            f.write("[\n")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(flush_interval,), name="trace", daemon=True
+        )
+        self._thread.start()
+
+    def _append(self, event):
+        tid = threading.get_native_id()
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self.events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self.pid,
+                    "tid": tid,
+                    "args": {"name": threading.current_thread().name},
+                }
+            )
+        event["pid"] = self.pid
+        event["tid"] = tid
+        self.events.append(event)
+
+    def complete(self, name, start, end, category, args=None):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": (end - start) * 1e6,
+        }
+        if args:
+            event["args"] = args
+        self._append(event)
+
+    def instant(self, name, at, category, args=None):
+        event = {"name": name, "cat": category, "ph": "i", "s": "t", "ts": at * 1e6}
+        if args:
+            event["args"] = args
+        self._append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        r"""
+        Records the duration of the `with` block; the block can add to the
+        args it gets.
+        """
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.complete(name, start, time.perf_counter(), category, args)
+
+    def flush(self):
+        lines = []
+        while self.events:
+            lines.append(json.dumps(self.events.popleft()))
+        if lines:
+            with open(self.path, "a") as f:
+                f.write(",\n".join(lines) + ",\n")
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.flush()
+
+    def close(self):
+        r"""
+        Writes the last events and closes the JSON array. Until then the file
+        ends with a comma, which the trace viewers accept.
+        """
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        with open(self.path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 2:
+                f.seek(-2, os.SEEK_END)  # (the last ",\n")
+                f.truncate()
+            f.write(b"\n]\n")